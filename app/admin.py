@@ -1,26 +1,330 @@
-from django.contrib import admin
+from urllib.parse import unquote, urlparse
 
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
+from django.db.models import F, Func
+from django.template.defaultfilters import filesizeformat
+from django.utils.html import format_html_join
+from django.utils.safestring import mark_safe
+
+from app import metrics
+from app.file_urls import bind_resolver, get_request_resolver, get_resolver
 from app.forms import ModelWithFilesArrayForm, ModelWithImagesArrayForm
-from app.models import ModelWithFilesArray, ModelWithImagesArray
+from app.metadata import METADATA_FIELD
+from app.models import (FilesImportJob, ModelWithFilesArray,
+                        ModelWithImagesArray)
+from app.renditions import (RENDITIONS_FIELD, get_rendition, queue_renditions,
+                            schedule_renditions)
+from app.utils import ArrayHead, ArrayLength, JSONBSubset
+
+COUNT_SUFFIX = '_count'
+HEAD_SUFFIX = '_head'
+
+
+class FileURLsChangeList(ChangeList):
+    """
+    Список, в котором массивы не загружаются целиком,
+    а URL файлов всей страницы получаются одной пачкой.
+    """
+    def get_queryset(self, request):
+        # число файлов нужно до сортировки по нему; сами массивы
+        # не откладываются: этот же queryset получают действия,
+        # а обработчики удаления читают массивы целиком
+        if not getattr(self, 'array_counts', False):
+            self.root_queryset = self.model_admin.get_array_counts_queryset(
+                self.root_queryset
+            )
+            self.array_counts = True
+        return super().get_queryset(request)
+
+    def get_results(self, request):
+        queryset = self.queryset
+        self.queryset = self.model_admin.get_array_heads_queryset(queryset)
+        try:
+            super().get_results(request)
+        finally:
+            self.queryset = queryset
+        self.model_admin.prefetch_file_urls(request, self.result_list)
+
+
+class FileURLsAdminMixin:
+    """
+    URL файлов массивов берутся из кэша, а не у хранилища.
+    В списке объектов из БД читаются только число элементов массивов
+    (cardinality) и первые list_preview_size из них (срез в SQL),
+    а метаданные и производные - только для этих элементов.
+    Размер страницы списка не зависит от длины массивов.
+    """
+    file_url_fields = []
+    list_preview_size = 5
+    # словари {путь: данные}, которые в списке читаются частично
+    file_data_fields = [METADATA_FIELD, RENDITIONS_FIELD]
+
+    def get_changelist(self, request, **kwargs):
+        return FileURLsChangeList
+
+    def get_array_counts_queryset(self, queryset):
+        return queryset.annotate(**{
+            field_name + COUNT_SUFFIX: ArrayLength(field_name)
+            for field_name in self.file_url_fields
+        })
+
+    def get_array_heads_queryset(self, queryset):
+        """Только для выводимой страницы: массивы откладываются."""
+        model_fields = {field.name for field in self.model._meta.fields}
+        annotations = {}
+        heads = []
+        for field_name in self.file_url_fields:
+            head = ArrayHead(
+                F(field_name), self.list_preview_size,
+                output_field=self.model._meta.get_field(field_name)
+            )
+            annotations[field_name + HEAD_SUFFIX] = head
+            heads.append(head)
+        data_fields = [
+            field_name for field_name in self.file_data_fields
+            if field_name in model_fields
+        ]
+        if heads:
+            keys = heads[0]
+            for head in heads[1:]:
+                keys = Func(
+                    keys, head, function='array_cat',
+                    output_field=head.output_field
+                )
+            for field_name in data_fields:
+                annotations[field_name + HEAD_SUFFIX] = JSONBSubset(
+                    F(field_name), keys
+                )
+        return queryset.annotate(**annotations).defer(
+            *self.file_url_fields, *data_fields
+        )
+
+    def get_preview(self, instance, field_name):
+        """
+        Первые элементы массива (или словаря файлов): в списке -
+        из аннотаций get_array_heads_queryset, иначе из самого поля.
+        """
+        head = field_name + HEAD_SUFFIX
+        if head in instance.__dict__:
+            value = instance.__dict__[head]
+            # срез массива NULL - NULL
+            return [] if value is None else value
+        value = getattr(instance, field_name)
+        if isinstance(value, dict):
+            return value
+        return (value or [])[:self.list_preview_size]
+
+    def get_count(self, instance, field_name):
+        count = field_name + COUNT_SUFFIX
+        if count in instance.__dict__:
+            return instance.__dict__[count]
+        return len(getattr(instance, field_name) or [])
+
+    def get_file_paths(self, instance):
+        """Пути файлов объекта, URL которых понадобятся в списке."""
+        for field_name in self.file_url_fields:
+            yield from self.get_preview(instance, field_name)
+
+    def prefetch_file_urls(self, request, objects):
+        resolver = get_request_resolver(request)
+        resolver.prefetch(
+            path for instance in objects
+            for path in self.get_file_paths(instance)
+        )
+        for instance in objects:
+            bind_resolver(instance, resolver)
+
+
+class MetricsAdminMixin:
+    """При DEBUG показывает сводку метрик сохранения объекта."""
+
+    def changeform_view(self, request, *args, **kwargs):
+        if not settings.DEBUG or request.method != 'POST':
+            return super().changeform_view(request, *args, **kwargs)
+        with metrics.collect() as summary:
+            response = super().changeform_view(request, *args, **kwargs)
+        if summary:
+            self.message_user(
+                request, f'Метрики: {summary.format()}', messages.INFO
+            )
+        return response
+
+
+class FilePathSearchAdminMixin:
+    """
+    Поиск объектов по путям или URL файлов (через пробел).
+    Использует FilesArrayQuerySet.referencing и GIN-индексы массивов,
+    число ищется как id объекта.
+    """
+    search_fields = ['=id']
+    search_help_text = 'Путь или URL файла (можно несколько через пробел)'
+    file_search_fields = None
+
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term or search_term.isdigit():
+            return super().get_search_results(
+                request, queryset, search_term
+            )
+        paths = [
+            unquote(urlparse(term).path).removeprefix(settings.MEDIA_URL)
+            if '://' in term or term.startswith(settings.MEDIA_URL)
+            else term
+            for term in search_term.split()
+        ]
+        return queryset.referencing(paths, self.file_search_fields), False
 
 
 @admin.register(ModelWithImagesArray)
-class ModelWithImagesArrayAdmin(admin.ModelAdmin):
+class ModelWithImagesArrayAdmin(FileURLsAdminMixin, FilePathSearchAdminMixin,
+                                MetricsAdminMixin, admin.ModelAdmin):
     form = ModelWithImagesArrayForm
+    list_display = ['__str__', 'images_count', 'preview']
     readonly_fields = ['uploaded_images']
+    file_url_fields = ['images']
+    thumbnail_rendition = 'thumb'
+    thumbnail_width = 200
+
+    def get_thumbnail(self, instance, image, renditions=None):
+        if self.thumbnail_rendition in settings.IMAGE_RENDITIONS:
+            return get_rendition(
+                instance, image, self.thumbnail_rendition, renditions
+            )
+
+    def get_missing_thumbnails(self, instance, images, renditions=None):
+        if self.thumbnail_rendition not in settings.IMAGE_RENDITIONS:
+            return []
+        return [
+            image for image in images
+            if not self.get_thumbnail(instance, image, renditions)
+        ]
+
+    def get_file_paths(self, instance):
+        renditions = self.get_preview(instance, RENDITIONS_FIELD)
+        for image in super().get_file_paths(instance):
+            yield image
+            thumbnail = self.get_thumbnail(instance, image, renditions)
+            if thumbnail:
+                yield thumbnail
+
+    def prefetch_file_urls(self, request, objects):
+        super().prefetch_file_urls(request, objects)
+        # недостающие миниатюры всей страницы - группой задач
+        queue_renditions([
+            (instance, image) for instance in objects
+            for image in self.get_missing_thumbnails(
+                instance, self.get_preview(instance, 'images'),
+                self.get_preview(instance, RENDITIONS_FIELD)
+            )
+        ])
+
+    def render_images(self, instance, images, width, renditions=None):
+        if not images:
+            return '-'
+        # пока миниатюра не готова, выводим уменьшенный оригинал
+        thumbnails = [
+            self.get_thumbnail(instance, image, renditions) or image
+            for image in images
+        ]
+        resolver = get_resolver(instance)
+        resolver.prefetch(images + thumbnails)
+        return format_html_join(
+            '\n', '<a href="{}"><img src="{}" width="{}" alt="{}"></a>',
+            (
+                (resolver.url(image), resolver.url(thumbnail), width, image)
+                for image, thumbnail in zip(images, thumbnails)
+            )
+        )
 
     def uploaded_images(self, instance):
-        return '\n'.join(map(str, instance.images or [])) or '-'
+        images = instance.images or []
+        schedule_renditions(
+            instance, self.get_missing_thumbnails(instance, images)
+        )
+        return self.render_images(instance, images, self.thumbnail_width)
 
     uploaded_images.short_description = 'Загруженные изображения'
 
+    def preview(self, instance):
+        return self.render_images(
+            instance, self.get_preview(instance, 'images'), 50,
+            self.get_preview(instance, RENDITIONS_FIELD)
+        )
+
+    preview.short_description = 'Изображения'
+
+    def images_count(self, instance):
+        return self.get_count(instance, 'images')
+
+    images_count.short_description = 'Количество'
+    images_count.admin_order_field = 'images_count'
+
 
 @admin.register(ModelWithFilesArray)
-class ModelWithFilesArrayAdmin(admin.ModelAdmin):
+class ModelWithFilesArrayAdmin(FileURLsAdminMixin, FilePathSearchAdminMixin,
+                               MetricsAdminMixin, admin.ModelAdmin):
     form = ModelWithFilesArrayForm
+    list_display = ['__str__', 'files_count', 'preview']
     readonly_fields = ['uploaded_files']
+    file_url_fields = ['files']
+
+    def render_files(self, instance, files, metadata=None):
+        if not files:
+            return '-'
+        # размеры берутся из метаданных, без обращений к хранилищу
+        if metadata is None:
+            metadata = instance.files_metadata or {}
+        sizes = [metadata.get(file, {}).get('size') for file in files]
+        sizes = [filesizeformat(size) if size else '-' for size in sizes]
+        return format_html_join(
+            mark_safe('<br>'), '<a href="{}">{}</a> ({})',
+            zip(get_resolver(instance).urls_for(files), files, sizes)
+        )
 
     def uploaded_files(self, instance):
-        return '\n'.join(map(str, instance.files or [])) or '-'
+        return self.render_files(instance, instance.files or [])
 
     uploaded_files.short_description = 'Загруженные файлы'
+
+    def preview(self, instance):
+        return self.render_files(
+            instance, self.get_preview(instance, 'files'),
+            self.get_preview(instance, METADATA_FIELD)
+        )
+
+    preview.short_description = 'Файлы'
+
+    def files_count(self, instance):
+        return self.get_count(instance, 'files')
+
+    files_count.short_description = 'Количество'
+    files_count.admin_order_field = 'files_count'
+
+
+@admin.register(FilesImportJob)
+class FilesImportJobAdmin(admin.ModelAdmin):
+    list_display = ['__str__', 'status', 'progress', 'errors_count',
+                    'created_at', 'updated_at']
+    list_filter = ['status', 'content_type']
+    readonly_fields = ['content_type', 'object_id', 'field_name', 'status',
+                       'progress', 'urls', 'files', 'errors',
+                       'created_at', 'updated_at']
+    exclude = ['processed']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def progress(self, instance):
+        return f'{instance.processed} / {len(instance.urls)}'
+
+    progress.short_description = 'Прогресс'
+
+    def errors_count(self, instance):
+        return len(instance.errors)
+
+    errors_count.short_description = 'Ошибок'
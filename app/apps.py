@@ -4,3 +4,14 @@ from django.apps import AppConfig
 class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
+
+    def ready(self):
+        from celery.signals import task_postrun
+        from django.core.signals import request_finished
+
+        from app import checks  # noqa: F401
+        from app import metrics
+
+        # метрики копятся в процессе и отправляются в конце запроса/задачи
+        request_finished.connect(metrics.flush)
+        task_postrun.connect(metrics.flush, weak=False)
@@ -0,0 +1,155 @@
+"""
+Ленивый доступ к файлам из массивов модели.
+Элементы массивов FilesArrayModelField - строки ArrayFieldFile:
+их можно использовать везде, где раньше использовались пути,
+а url, size и exists вычисляются при первом обращении и запоминаются.
+prefetch_array_files (и FilesArrayQuerySet.prefetch_files) заранее
+получает URL всех файлов списка объектов одним обращением к кэшу,
+размеры берутся из метаданных, поэтому на странице списка нет
+обращений к хранилищу на каждый файл.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.core.files.storage import default_storage
+from django.db.models.query_utils import DeferredAttribute
+
+from app import metrics
+from app.file_urls import get_resolver, prefetch_file_urls
+
+
+class ArrayFieldFile(str):
+    """
+    Путь файла из массива с ленивыми свойствами, аналог FieldFile.
+    Сравнивается, хэшируется и сохраняется в БД как обычная строка.
+    """
+    def __new__(cls, name, instance=None):
+        file = super().__new__(cls, name)
+        file.instance = instance
+        return file
+
+    def __reduce__(self):
+        # в кэш и копии попадает только путь
+        return str, (str(self),)
+
+    @property
+    def name(self):
+        return str(self)
+
+    @property
+    def storage(self):
+        return default_storage
+
+    @property
+    def metadata(self):
+        get_file_metadata = getattr(self.instance, 'get_file_metadata', None)
+        return get_file_metadata(self) if get_file_metadata else {}
+
+    @property
+    def url(self):
+        if '_url' not in self.__dict__:
+            self._url = get_resolver(self.instance).url(str(self))
+        return self._url
+
+    @property
+    def size(self):
+        if '_size' not in self.__dict__:
+            size = self.metadata.get('size')
+            if size is None:
+                size = self.storage.size(self)
+            self._size = size
+        return self._size
+
+    @property
+    def exists(self):
+        if '_exists' not in self.__dict__:
+            self._exists = self.storage.exists(self)
+        return self._exists
+
+    def open(self, mode='rb'):
+        return self.storage.open(self, mode)
+
+
+class FilesArrayDescriptor(DeferredAttribute):
+    """
+    Оборачивает элементы массива в ArrayFieldFile при чтении.
+    Как и FileDescriptor, это data-дескриптор (есть __set__),
+    иначе значение из __dict__ объекта читалось бы в обход него.
+    """
+
+    def __get__(self, instance, cls=None):
+        if instance is None:
+            return self
+        value = super().__get__(instance, cls)
+        # до сохранения в поле могут лежать загруженные файлы
+        # или выражение для UPDATE, их не трогаем
+        if isinstance(value, list) and not all(
+            type(item) is ArrayFieldFile and item.instance is instance
+            or not isinstance(item, str)
+            for item in value
+        ):
+            # на месте, чтобы не терять изменения списка
+            value[:] = [
+                ArrayFieldFile(item, instance) if isinstance(item, str)
+                else item
+                for item in value
+            ]
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+
+
+class FilesArrayModelField(ArrayField):
+    """ArrayField из FileField/ImageField с ленивыми элементами."""
+    descriptor_class = FilesArrayDescriptor
+
+
+def prefetch_array_files(objects, field_names=None, resolver=None,
+                         sizes=False):
+    """
+    Заранее получает URL всех файлов массивов field_names объектов
+    одним обращением к кэшу (prefetch_file_urls).
+    С sizes=True размеры файлов без метаданных запрашиваются
+    у хранилища параллельно, не более STORAGE_MAX_WORKERS потоков.
+    """
+    objects = list(objects)
+    if not objects:
+        return resolver
+    if field_names is None:
+        field_names = [
+            field.name for field in objects[0]._meta.fields
+            if isinstance(field, FilesArrayModelField)
+        ]
+    resolver = prefetch_file_urls(objects, field_names, resolver)
+    files = [
+        file
+        for instance in objects
+        for field_name in field_names
+        for file in getattr(instance, field_name) or []
+        if isinstance(file, ArrayFieldFile)
+    ]
+    for file in files:
+        file._url = resolver.urls[str(file)]
+    if sizes:
+        missing = [file for file in files if '_size' not in file.__dict__
+                   and file.metadata.get('size') is None]
+        if missing:
+            with metrics.span('storage.size_batch'), ThreadPoolExecutor(
+                max_workers=min(settings.STORAGE_MAX_WORKERS, len(missing))
+            ) as executor:
+                results = executor.map(
+                    metrics.in_context(get_storage_size), missing
+                )
+                for file, size in zip(missing, results):
+                    file._size = size
+    return resolver
+
+
+def get_storage_size(name):
+    """Размер файла в хранилище или None, если файла нет."""
+    try:
+        return default_storage.size(name)
+    except OSError:
+        return None
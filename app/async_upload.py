@@ -0,0 +1,159 @@
+"""
+Асинхронная загрузка файлов в массив объекта для ASGI.
+Ссылки скачиваются, а файлы проверяются и сохраняются в отдельном пуле
+потоков, поэтому цикл событий воркера не блокируется и один воркер
+обслуживает много загрузок одновременно. Файлы дописываются в массив
+одним aupdate.
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections
+
+from app import metrics
+from app.fetcher import FetchError, download
+from app.fields import files_input_field_for, url_input_field_for
+from app.metadata import (METADATA_FIELD, collect_metadata, has_metadata,
+                          metadata_expression)
+from app.models import StoredFile
+from app.renditions import has_renditions, schedule_renditions
+from app.storage import save_files
+from app.tasks import schedule_files_deletion
+from app.utils import array_edit_expression
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Пул потоков для блокирующих операций асинхронной загрузки."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=(
+                        settings.URL_FETCH_MAX_WORKERS
+                        + settings.STORAGE_MAX_WORKERS
+                    ),
+                    thread_name_prefix='array-files'
+                )
+    return _executor
+
+
+async def run_blocking(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(metrics.in_context(func), *args)
+    )
+
+
+async def check_upload(field, file):
+    """Проверка загруженного файла (Pillow для изображений) в пуле."""
+    try:
+        return (await run_blocking(field.to_python, [file]))[0]
+    except BaseException:
+        file.close()
+        raise
+
+
+async def fetch_url(field, url, semaphore):
+    """Скачивание и проверка файла по ссылке."""
+    async with semaphore:
+        try:
+            file = await run_blocking(download, url)
+        except FetchError as exc:
+            raise ValidationError(
+                field.error_messages['fetch_failed'],
+                code='fetch_failed',
+                params={'url': url, 'reason': str(exc)}
+            ) from exc
+    try:
+        return await run_blocking(field.check_url_file, url, file)
+    except BaseException:
+        # файл, не прошедший проверку, дальше никому не нужен
+        file.close()
+        raise
+
+
+async def save(instance, field_name, files):
+    """
+    Сохраняет файлы в хранилище через save_files: резервирование имён,
+    дедупликация, параллельная запись и метрики те же, что в формах.
+    save_files обращается к БД, поэтому выполняется в пуле, а не в общем
+    потоке sync_to_async, чтобы параллельные загрузки не ждали друг друга.
+    """
+    return await run_blocking(save_files_closing, instance, field_name, files)
+
+
+def save_files_closing(instance, field_name, files):
+    # соединение с БД потока из пула закрывается как в конце запроса
+    try:
+        return save_files(instance, field_name, files)
+    finally:
+        close_old_connections()
+
+
+async def upload_to_array(instance, field_name, files=(), urls=()):
+    """
+    Проверяет файлы и скачивает ссылки параллельно, сохраняет прошедшие
+    проверку и дописывает их в массив объекта.
+    Возвращает сохранённые пути и список ошибок по отдельным файлам.
+    """
+    model = type(instance)
+    model_field = model._meta.get_field(field_name)
+    files_field = files_input_field_for(model_field)
+    url_field = url_input_field_for(model_field)
+    semaphore = asyncio.Semaphore(settings.URL_FETCH_MAX_WORKERS)
+    results = await asyncio.gather(
+        *(check_upload(files_field, file) for file in files),
+        *(fetch_url(url_field, url, semaphore) for url in urls),
+        return_exceptions=True
+    )
+    checked = []
+    failures = []
+    for result in results:
+        if isinstance(result, BaseException):
+            failures.append(result)
+        else:
+            checked.append(result)
+    try:
+        return await save_to_array(instance, field_name, checked, failures)
+    finally:
+        for file in checked:
+            file.close()
+
+
+async def save_to_array(instance, field_name, checked, failures):
+    """Сохраняет проверенные файлы и дописывает их в массив объекта."""
+    model = type(instance)
+    model_field = model._meta.get_field(field_name)
+    errors = []
+    for failure in failures:
+        if not isinstance(failure, ValidationError):
+            raise failure
+        errors.extend(failure.messages)
+    if not checked:
+        return [], errors
+    saved = await save(instance, field_name, checked)
+    updates = {field_name: array_edit_expression(model_field, appended=saved)}
+    if has_metadata(model):
+        updates[METADATA_FIELD] = metadata_expression(
+            merged=collect_metadata(saved, checked)
+        )
+    with_renditions = has_renditions(model, field_name)
+    if not await model.objects.filter(pk=instance.pk).aupdate(**updates):
+        # объект удалили во время загрузки
+        await sync_to_async(schedule_files_deletion)(
+            await sync_to_async(StoredFile.objects.release)(saved),
+            with_renditions
+        )
+        return [], errors + ['Объект удалён во время загрузки']
+    if with_renditions:
+        await sync_to_async(schedule_renditions)(instance, saved)
+    return saved, errors
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core import checks
+
+from app.naming import get_naming_strategy, hash_file_name
+
+
+@checks.register()
+def check_naming_strategy(app_configs, **kwargs):
+    """
+    Имена по хэшу без дедупликации: одинаковые файлы разных объектов
+    получают один путь, и удаление одного объекта удалит файл другого.
+    """
+    if settings.FILES_DEDUPLICATE:
+        return []
+    try:
+        strategy = get_naming_strategy()
+    except ImportError as exc:
+        return [checks.Error(
+            f'Не удалось импортировать стратегию именования: {exc}',
+            id='app.E002',
+        )]
+    if strategy is hash_file_name:
+        return [checks.Error(
+            "Стратегия именования 'hash' без FILES_DEDUPLICATE: "
+            'одинаковые файлы разных объектов получат общий путь '
+            'и будут удаляться вместе.',
+            hint="Включите FILES_DEDUPLICATE=1 или выберите другую "
+                 'FILES_NAMING_STRATEGY.',
+            id='app.E001',
+        )]
+    return []
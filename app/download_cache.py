@@ -0,0 +1,191 @@
+"""
+Дисковый кэш файлов, скачанных по ссылкам.
+Для ответов с ETag или Last-Modified тело сохраняется в URL_CACHE_DIR,
+а при повторной загрузке той же ссылки отправляется условный запрос
+(If-None-Match / If-Modified-Since): на ответ 304 файл берётся из кэша.
+Общий размер кэша ограничен URL_CACHE_MAX_SIZE, при превышении
+удаляются давно не использованные записи (LRU по времени изменения).
+Размер кэша считается в процессе по мере записи, каталог сканируется
+только при превышении лимита и раз в RESCAN_INTERVAL (кэш пополняют
+и другие процессы).
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+
+BODY_SUFFIX = '.body'
+META_SUFFIX = '.json'
+
+# после очистки кэш занимает не больше этой доли URL_CACHE_MAX_SIZE,
+# чтобы следующая очистка понадобилась не сразу
+EVICT_TARGET = 0.9
+# как часто пересчитывать размер кэша по каталогу, сек.
+RESCAN_INTERVAL = 5 * 60
+
+_evict_lock = threading.Lock()
+_size_lock = threading.Lock()
+# размер кэша по последнему сканированию и записям процесса после него
+_size = None
+_scanned_at = 0.0
+
+
+class CachedFile(UploadedFile):
+    """
+    Файл из кэша загрузок.
+    Намеренно без temporary_file_path: хранилище должно скопировать
+    файл, а не переместить его из кэша.
+    """
+    def __init__(self, path, entry):
+        super().__init__(
+            open(path, 'rb'), entry['name'], entry.get('content_type'),
+            entry['size']
+        )
+        self.sha256 = entry.get('sha256')
+
+
+def is_enabled():
+    return settings.URL_CACHE_MAX_SIZE > 0
+
+
+def get_paths(url):
+    key = hashlib.sha256(url.encode()).hexdigest()
+    base = os.path.join(settings.URL_CACHE_DIR, key)
+    return base + BODY_SUFFIX, base + META_SUFFIX
+
+
+def get_entry(url):
+    """Метаданные записи кэша для ссылки или None."""
+    body_path, meta_path = get_paths(url)
+    try:
+        with open(meta_path) as file:
+            entry = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if entry.get('url') != url or not os.path.exists(body_path):
+        return None
+    return entry
+
+
+def conditional_headers(entry):
+    headers = {}
+    if entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def open_entry(url, entry):
+    """Файл из кэша; запись отмечается как недавно использованная."""
+    body_path, _ = get_paths(url)
+    try:
+        os.utime(body_path)
+        return CachedFile(body_path, entry)
+    except OSError:
+        return None
+
+
+def store(url, response, file):
+    """
+    Сохраняет скачанный файл в кэш, если ответ можно перепроверить
+    условным запросом. Запись выполняется через временный файл,
+    поэтому параллельные загрузки не видят её недописанной.
+    """
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if not (etag or last_modified) or file.size > settings.URL_CACHE_MAX_SIZE:
+        return
+    os.makedirs(settings.URL_CACHE_DIR, exist_ok=True)
+    body_path, meta_path = get_paths(url)
+    entry = {
+        'url': url,
+        'etag': etag,
+        'last_modified': last_modified,
+        'name': file.name,
+        'content_type': file.content_type,
+        'size': file.size,
+        'sha256': getattr(file, 'sha256', None),
+    }
+    try:
+        with tempfile.NamedTemporaryFile(
+            dir=settings.URL_CACHE_DIR, delete=False
+        ) as body:
+            file.seek(0)
+            shutil.copyfileobj(file, body)
+        file.seek(0)
+        try:
+            replaced = os.path.getsize(body_path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(body.name, body_path)
+        with tempfile.NamedTemporaryFile(
+            'w', dir=settings.URL_CACHE_DIR, delete=False
+        ) as meta:
+            json.dump(entry, meta)
+        os.replace(meta.name, meta_path)
+    except OSError:
+        # кэш необязателен: ошибка записи не мешает загрузке
+        return
+    track(file.size - replaced)
+
+
+def track(added):
+    """Учитывает записанные байты и при необходимости очищает кэш."""
+    global _size
+    with _size_lock:
+        if _size is not None:
+            _size += added
+        due = (
+            _size is None or _size > settings.URL_CACHE_MAX_SIZE
+            or time.monotonic() - _scanned_at > RESCAN_INTERVAL
+        )
+    if due:
+        evict()
+
+
+def evict():
+    """
+    Сканирует каталог кэша и, если он больше URL_CACHE_MAX_SIZE,
+    удаляет давно не использованные записи до EVICT_TARGET от лимита.
+    """
+    global _size, _scanned_at
+    if not _evict_lock.acquire(blocking=False):
+        # очистку уже выполняет другой поток
+        return
+    try:
+        entries = []
+        total = 0
+        with os.scandir(settings.URL_CACHE_DIR) as iterator:
+            for item in iterator:
+                if not item.name.endswith(BODY_SUFFIX):
+                    continue
+                stat = item.stat()
+                entries.append((stat.st_mtime, stat.st_size, item.path))
+                total += stat.st_size
+        if total > settings.URL_CACHE_MAX_SIZE:
+            target = settings.URL_CACHE_MAX_SIZE * EVICT_TARGET
+        else:
+            target = total
+        entries.sort()
+        for _, size, body_path in entries:
+            if total <= target:
+                break
+            meta_path = body_path[:-len(BODY_SUFFIX)] + META_SUFFIX
+            for path in (meta_path, body_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+        with _size_lock:
+            _size = total
+            _scanned_at = time.monotonic()
+    finally:
+        _evict_lock.release()
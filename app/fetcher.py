@@ -0,0 +1,450 @@
+"""
+Общий загрузчик файлов по ссылкам для полей форм, задач celery,
+асинхронной загрузки и команды импорта.
+Соединения переиспользуются (пул на каждый хост), обращения к одному
+хосту ограничиваются token bucket, перенаправления проверяются
+и ограничены по числу, соединения с адресами из внутренних сетей
+не устанавливаются (SSRF), а хосты, которые подряд отвечают ошибками, временно
+отключаются (circuit breaker). Лимиты и состояние хостов общие
+для всех потоков процесса.
+"""
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urljoin, urlparse
+
+import requests
+from django.conf import settings
+from django.core.files.uploadedfile import (InMemoryUploadedFile,
+                                            TemporaryUploadedFile)
+from requests.adapters import HTTPAdapter
+from requests.utils import get_environ_proxies
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+
+from app import download_cache, metrics
+
+# хостов, для которых хранятся лимиты и состояние
+MAX_TRACKED_HOSTS = 1024
+
+_session = None
+_session_lock = threading.Lock()
+_hosts = OrderedDict()
+_hosts_lock = threading.Lock()
+
+
+class FetchError(Exception):
+    """Ошибка загрузки файла по ссылке."""
+
+
+class FetchResult:
+    """Результат загрузки одной ссылки: файл или текст ошибки."""
+    def __init__(self, url, file=None, error=None):
+        self.url = url
+        self.file = file
+        self.error = error
+
+
+def close_results(results):
+    """Закрывает файлы результатов, которые больше никому не нужны."""
+    for result in results:
+        if result.file is not None:
+            result.file.close()
+
+
+def close_future_file(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class TokenBucket:
+    """
+    Ограничение частоты запросов: rate в секунду, до burst подряд.
+    Запрос, которому не хватило токена, ждёт своей очереди.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, max_wait):
+        """Занимает токен и возвращает время ожидания, сек."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            delay = max(0, (1 - self.tokens) / self.rate)
+            if delay > max_wait:
+                return None
+            self.tokens -= 1
+            return delay
+
+
+class CircuitBreaker:
+    """
+    После threshold ошибок подряд хост отключается на cooldown секунд,
+    затем пропускается один пробный запрос: при успехе хост включается,
+    при ошибке снова отключается.
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.trial or (
+                time.monotonic() - self.opened_at < self.cooldown
+            ):
+                return False
+            self.trial = True
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                if self.opened_at is None or self.trial:
+                    metrics.incr('circuit_opened')
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+
+class HostState:
+    """Лимит запросов и состояние доступности одного хоста."""
+    def __init__(self):
+        rate = settings.URL_FETCH_HOST_RATE
+        self.bucket = TokenBucket(
+            rate, settings.URL_FETCH_HOST_BURST
+        ) if rate else None
+        self.breaker = CircuitBreaker(
+            settings.URL_FETCH_BREAKER_THRESHOLD,
+            settings.URL_FETCH_BREAKER_COOLDOWN
+        )
+
+
+def get_host_state(host):
+    with _hosts_lock:
+        state = _hosts.get(host)
+        if state is None:
+            state = _hosts[host] = HostState()
+            if len(_hosts) > MAX_TRACKED_HOSTS:
+                _hosts.popitem(last=False)
+        else:
+            _hosts.move_to_end(host)
+        return state
+
+
+def is_public_address(address):
+    address = ipaddress.ip_address(address.split('%', 1)[0])
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return address.is_global and not address.is_multicast
+
+
+def check_url(url):
+    """
+    Проверяет ссылку перед запросом и возвращает её хост.
+    Адрес сервера проверяется при установке соединения
+    (CheckedConnectionMixin), а через прокси - заранее здесь.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise FetchError('некорректная ссылка')
+    if get_session().trust_env and get_environ_proxies(url):
+        # соединение устанавливается с прокси, адрес сервера
+        # определит он сам, поэтому проверка только предварительная
+        resolve_public_addresses(parsed.hostname, parsed.port or 80)
+    return parsed.hostname
+
+
+def resolve_public_addresses(host, port):
+    """
+    Адреса хоста для соединения или None, если проверка не нужна.
+    Хост должен разрешаться только в публичные адреса,
+    если он не указан в URL_FETCH_ALLOWED_HOSTS.
+    """
+    if not settings.URL_FETCH_BLOCK_PRIVATE or (
+        host in settings.URL_FETCH_ALLOWED_HOSTS
+    ):
+        return None
+    try:
+        addresses = list(dict.fromkeys(
+            info[4][0] for info in socket.getaddrinfo(
+                host, port, proto=socket.IPPROTO_TCP
+            )
+        ))
+    except (socket.gaierror, UnicodeError) as exc:
+        raise FetchError('не удалось определить адрес сервера') from exc
+    if not all(map(is_public_address, addresses)):
+        metrics.incr('fetch_blocked')
+        raise FetchError('адрес сервера находится во внутренней сети')
+    return addresses
+
+
+class CheckedConnectionMixin:
+    """
+    Соединение только с проверенными адресами сервера: хост
+    разрешается один раз, и сокет открывается к полученному адресу,
+    поэтому DNS не может подменить адрес между проверкой
+    и соединением. Имя хоста остаётся в Host, SNI и при проверке
+    сертификата.
+    """
+    def _new_conn(self):
+        host = self._dns_host
+        addresses = resolve_public_addresses(host.rstrip('.'), self.port)
+        if addresses is None:
+            return super()._new_conn()
+        error = FetchError('не удалось определить адрес сервера')
+        try:
+            for address in addresses:
+                self._dns_host = address
+                try:
+                    return super()._new_conn()
+                except NewConnectionError as exc:
+                    error = exc
+        finally:
+            self._dns_host = host
+        raise error
+
+
+class CheckedHTTPConnection(CheckedConnectionMixin, HTTPConnection):
+    pass
+
+
+class CheckedHTTPSConnection(CheckedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class CheckedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CheckedHTTPConnection
+
+
+class CheckedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CheckedHTTPSConnection
+
+
+class CheckedAddressAdapter(HTTPAdapter):
+    """Адаптер requests, соединения которого проверяют адрес сервера."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CheckedHTTPConnectionPool,
+            'https': CheckedHTTPSConnectionPool,
+        }
+
+
+def get_session():
+    """
+    Общая сессия requests с пулом соединений (keep-alive).
+    Создаётся один раз на процесс и переиспользуется всеми потоками:
+    на каждый хост (до URL_FETCH_POOL_HOSTS) свой пул соединений.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = CheckedAddressAdapter(
+                    pool_connections=settings.URL_FETCH_POOL_HOSTS,
+                    pool_maxsize=settings.URL_FETCH_MAX_WORKERS
+                )
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def file_name_from_url(url):
+    return os.path.basename(urlparse(url).path)
+
+
+def get(url, headers=None):
+    """
+    GET-запрос с потоковым чтением тела. Перенаправления выполняются
+    вручную (не больше URL_FETCH_MAX_REDIRECTS), чтобы проверить
+    каждый адрес; перед запросом учитываются лимит и состояние хоста.
+    """
+    for _ in range(settings.URL_FETCH_MAX_REDIRECTS + 1):
+        host = check_url(url)
+        state = get_host_state(host)
+        if state.bucket is not None:
+            delay = state.bucket.reserve(settings.URL_FETCH_TOTAL_TIMEOUT)
+            if delay is None:
+                raise FetchError('превышен лимит запросов к серверу')
+            if delay:
+                metrics.incr('rate_limited')
+                with metrics.span('url.rate_limit_wait'):
+                    time.sleep(delay)
+        if not state.breaker.allow():
+            metrics.incr('circuit_rejected')
+            raise FetchError('сервер временно недоступен')
+        try:
+            response = get_session().get(
+                url, timeout=settings.URL_FETCH_TIMEOUT, stream=True,
+                headers=headers, allow_redirects=False
+            )
+        except Exception:
+            # любой исход, в том числе FetchError из проверки адреса
+            # при соединении, завершает пробный запрос
+            state.breaker.failure()
+            raise
+        if response.status_code >= 500 or response.status_code == 429:
+            state.breaker.failure()
+        else:
+            state.breaker.success()
+        if not response.is_redirect:
+            return response
+        url = urljoin(url, response.headers['Location'])
+        response.close()
+    raise FetchError('слишком много перенаправлений')
+
+
+def download(url):
+    """
+    Скачивает файл по ссылке потоково и возвращает его как загруженный файл.
+    Тело читается частями: пока файл меньше FILE_UPLOAD_MAX_MEMORY_SIZE,
+    он хранится в памяти, дальше переносится во временный файл на диске,
+    как это делают обработчики загрузки Django.
+    Загрузка прерывается при превышении URL_UPLOAD_MAX_SIZE.
+    Если ссылка уже скачивалась, запрос отправляется условным,
+    и на ответ 304 файл берётся из кэша загрузок.
+    """
+    max_size = settings.URL_UPLOAD_MAX_SIZE
+    entry = headers = None
+    if download_cache.is_enabled():
+        entry = download_cache.get_entry(url)
+        headers = download_cache.conditional_headers(entry) if entry else None
+    try:
+        with metrics.span('url.download'), get(url, headers) as response:
+            if response.status_code == 304 and entry:
+                file = download_cache.open_entry(url, entry)
+                if file is None:
+                    # запись удалили между проверкой и чтением
+                    return download(url)
+                metrics.incr('url_cache_hits')
+                metrics.incr('url_cache_saved_bytes', file.size)
+                return file
+            if response.status_code != 200:
+                raise FetchError(f'сервер вернул код {response.status_code}')
+            content_length = response.headers.get('Content-Length')
+            if content_length and content_length.isdigit() and (
+                int(content_length) > max_size
+            ):
+                raise FetchError(f'размер файла превышает {max_size} байт')
+            content_type = response.headers.get('Content-Type', '')
+            content_type = content_type.split(';')[0].strip() or None
+            file = _read_body(response, file_name_from_url(url), content_type)
+            if download_cache.is_enabled():
+                download_cache.store(url, response, file)
+            return file
+    except requests.Timeout as exc:
+        raise FetchError('превышено время ожидания') from exc
+    except requests.RequestException as exc:
+        raise FetchError('ошибка соединения') from exc
+
+
+def _read_body(response, file_name, content_type):
+    max_size = settings.URL_UPLOAD_MAX_SIZE
+    memory_size = settings.FILE_UPLOAD_MAX_MEMORY_SIZE
+    buffer = io.BytesIO()
+    file = None
+    size = 0
+    sha256 = hashlib.sha256()
+    try:
+        for chunk in response.iter_content(
+            chunk_size=settings.URL_FETCH_CHUNK_SIZE
+        ):
+            size += len(chunk)
+            sha256.update(chunk)
+            if size > max_size:
+                raise FetchError(f'размер файла превышает {max_size} байт')
+            if file is None and size > memory_size:
+                file = TemporaryUploadedFile(file_name, content_type, 0, None)
+                file.write(buffer.getvalue())
+                buffer = None
+            if file is None:
+                buffer.write(chunk)
+            else:
+                file.write(chunk)
+    except BaseException:
+        if file is not None:
+            file.close()
+        raise
+    if file is None:
+        buffer.seek(0)
+        file = InMemoryUploadedFile(
+            buffer, 'FileField', file_name, content_type, size, None
+        )
+    else:
+        file.seek(0)
+        file.size = size
+    file.sha256 = sha256.hexdigest()
+    metrics.incr('fetched_files')
+    metrics.incr('fetched_bytes', size)
+    return file
+
+
+def fetch_urls(urls):
+    """
+    Параллельно скачивает файлы по списку ссылок.
+    Число одновременных загрузок ограничено URL_FETCH_MAX_WORKERS,
+    общее время ожидания - URL_FETCH_TOTAL_TIMEOUT.
+    Возвращает список FetchResult в порядке исходных ссылок.
+    """
+    if not urls:
+        return []
+    executor = ThreadPoolExecutor(
+        max_workers=min(settings.URL_FETCH_MAX_WORKERS, len(urls))
+    )
+    try:
+        futures = [
+            executor.submit(metrics.in_context(download), url)
+            for url in urls
+        ]
+        with metrics.span('url.fetch'):
+            wait(futures, timeout=settings.URL_FETCH_TOTAL_TIMEOUT)
+        results = []
+        for url, future in zip(urls, futures):
+            if not future.done():
+                if not future.cancel():
+                    # файл зависшей загрузки закроется, когда она кончится
+                    future.add_done_callback(close_future_file)
+                results.append(
+                    FetchResult(url, error='превышено общее время загрузки')
+                )
+                metrics.incr('fetch_errors')
+            elif future.exception() is not None:
+                exc = future.exception()
+                error = str(exc) if isinstance(exc, FetchError) else repr(exc)
+                results.append(FetchResult(url, error=error))
+                metrics.incr('fetch_errors')
+            else:
+                results.append(FetchResult(url, file=future.result()))
+        return results
+    finally:
+        # не ждём зависшие загрузки: их ограничивает URL_FETCH_TIMEOUT
+        executor.shutdown(wait=False, cancel_futures=True)
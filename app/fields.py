@@ -1,17 +1,43 @@
-import io
-import sys
+import copy
+import uuid
+from urllib.parse import urlparse
 
-import requests
 from PIL import Image
 from django import forms
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.uploadedfile import UploadedFile
+from django.db import models
 from django.forms import (CheckboxInput, ClearableFileInput, FileField,
                           ImageField, Textarea)
+from django.urls import reverse
+
+from app import metrics
+from app.fetcher import close_results, fetch_urls
+from app.file_urls import FileURLResolver
+from app.inspection import inspect_file, is_type_allowed
+from app.models import UploadSession
 
 FILE_INPUT_CONTRADICTION = object()
 
 
+class UploadSessionFile(UploadedFile):
+    """
+    Файл, собранный из частей на диске.
+    Хранилища Django перемещают такие файлы по temporary_file_path,
+    не копируя их содержимое.
+    """
+    def __init__(self, session):
+        super().__init__(
+            open(session.path, 'rb'), session.file_name,
+            session.content_type or None, session.size
+        )
+        self.session = session
+
+    def temporary_file_path(self):
+        return self.session.path
+
+
 class ClearableMultipleFilesInput(ClearableFileInput):
     """Виджет для поля загрузки нескольких файлов."""
     def value_from_datadict(self, data, files, name):
@@ -25,6 +51,109 @@ class ClearableMultipleFilesInput(ClearableFileInput):
         return upload
 
 
+class ChunkedFilesInput(ClearableMultipleFilesInput):
+    """
+    Виджет загрузки файлов частями в обход формы (см. app/views.py).
+    Файлы загружаются скриптом до отправки формы,
+    а сама форма получает только id сессий загрузки.
+    """
+    template_name = 'app/widgets/chunked_files_input.html'
+
+    class Media:
+        js = ['app/js/chunked_upload.js']
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        context['widget']['upload_url'] = reverse('app:create_upload')
+        context['widget']['parallel'] = settings.CHUNKED_UPLOAD_PARALLEL
+        return context
+
+    def value_from_datadict(self, data, files, name):
+        return data.get(name, '').split()
+
+    def value_omitted_from_data(self, data, files, name):
+        return not data.get(name)
+
+
+class FilesArrayEditInput(forms.Widget):
+    """
+    Обёртка над виджетом загрузки: выводит текущие файлы массива
+    с полями порядка и отметками удаления.
+    Правки читаются формой отдельно (edits_from_datadict),
+    значением поля остаются только новые файлы.
+    """
+    template_name = 'app/widgets/files_array_edit.html'
+
+    def __init__(self, widget, attrs=None):
+        self.widget = widget
+        self.entries = []
+        super().__init__(attrs)
+
+    def __deepcopy__(self, memo):
+        obj = super().__deepcopy__(memo)
+        obj.widget = copy.deepcopy(self.widget, memo)
+        obj.entries = list(self.entries)
+        return obj
+
+    @property
+    def media(self):
+        return self.widget.media
+
+    @property
+    def needs_multipart_form(self):
+        return self.widget.needs_multipart_form
+
+    def get_context(self, name, value, attrs):
+        context = super().get_context(name, value, attrs)
+        urls = FileURLResolver().urls_for(self.entries)
+        context['widget']['entries'] = [
+            {'path': path, 'url': url, 'position': position}
+            for position, (path, url) in enumerate(
+                zip(self.entries, urls), 1
+            )
+        ]
+        context['widget']['upload'] = self.widget.get_context(
+            name, value, context['widget']['attrs']
+        )['widget']
+        return context
+
+    def value_from_datadict(self, data, files, name):
+        return self.widget.value_from_datadict(data, files, name)
+
+    def value_omitted_from_data(self, data, files, name):
+        return self.widget.value_omitted_from_data(data, files, name)
+
+    def use_required_attribute(self, initial):
+        return self.widget.use_required_attribute(initial)
+
+    def id_for_label(self, id_):
+        return self.widget.id_for_label(id_)
+
+    def edits_from_datadict(self, data, name):
+        """
+        Удаляемые значения и новый порядок оставшихся
+        (None, если порядок не менялся).
+        """
+        try:
+            getter = data.getlist
+        except AttributeError:
+            getter = data.get
+        entries = getter(f'{name}_entry') or []
+        positions = getter(f'{name}_position') or []
+        removed = list(dict.fromkeys(getter(f'{name}_remove') or []))
+        keys = []
+        for index, entry in enumerate(entries):
+            try:
+                position = int(positions[index])
+            except (IndexError, TypeError, ValueError):
+                position = index + 1
+            keys.append((position, index, entry))
+        order = [entry for _, _, entry in sorted(keys)]
+        if order == entries:
+            order = None
+        return removed, order
+
+
 class URLTextarea(Textarea):
 
     def format_value(self, value):
@@ -34,6 +163,9 @@ class URLTextarea(Textarea):
 class FilesArrayFilesInputField(FileField):
     """Поле формы для загрузки нескольких файлов в админке."""
     widget = ClearableMultipleFilesInput(attrs={'multiple': True})
+    default_error_messages = {
+        'file_type': 'Файл %(name)s: тип %(type)s не разрешён.',
+    }
 
     def to_python(self, data):
         if data in self.empty_values:
@@ -64,8 +196,28 @@ class FilesArrayFilesInputField(FileField):
                     self.error_messages['empty'],
                     code='empty'
                 )
+            self.check_file_type(file_upload)
         return data
 
+    def check_file_type(self, file_upload):
+        """
+        Считает sha256 и определяет тип файла по содержимому
+        (app.inspection), тип сверяется с FILES_ALLOWED_TYPES.
+        """
+        inspect_file(file_upload)
+        if not is_type_allowed(
+            file_upload.sniffed_type, settings.FILES_ALLOWED_TYPES
+        ):
+            raise ValidationError(
+                self.error_messages['file_type'],
+                code='file_type',
+                params={
+                    'name': file_upload.name,
+                    'type': file_upload.sniffed_type
+                }
+            )
+        return file_upload
+
     def clean(self, data, initial=None):
         if data is FILE_INPUT_CONTRADICTION:
             raise ValidationError(
@@ -81,141 +233,284 @@ class FilesArrayFilesInputField(FileField):
         return self.to_python(data)
 
 
-class ImagesArrayFilesInputField(FilesArrayFilesInputField, ImageField):
+class ImageCheckMixin:
+    """
+    Проверка изображений без копирования в память.
+    Файл открывается напрямую (временные файлы - по пути на диске),
+    читается только заголовок: формат и размеры сверяются с настройками
+    IMAGE_ALLOWED_FORMATS, IMAGE_MAX_WIDTH, IMAGE_MAX_HEIGHT
+    и IMAGE_MAX_PIXELS до декодирования, что отсекает decompression bomb.
+    Полное декодирование выполняется только при IMAGE_FULL_DECODE.
+    """
+    default_error_messages = {
+        'image_format': 'Файл %(name)s: формат %(format)s не поддерживается.',
+        'image_too_large': 'Файл %(name)s: размер изображения '
+                           '%(width)sx%(height)s превышает допустимый.',
+        'image_bomb': 'Файл %(name)s: размер изображения превышает '
+                      'допустимый.',
+    }
+
+    def check_image(self, file_upload, invalid_error):
+        if hasattr(file_upload, 'temporary_file_path'):
+            source = file_upload.temporary_file_path()
+        else:
+            file_upload.seek(0)
+            source = file_upload
+        try:
+            with metrics.span('image.verify'), Image.open(source) as image:
+                self.check_image_limits(file_upload, image)
+                if settings.IMAGE_FULL_DECODE:
+                    image.load()
+        except ValidationError:
+            raise
+        except Image.DecompressionBombError as exc:
+            # Pillow отказывается открывать такие изображения сам
+            raise ValidationError(
+                self.error_messages['image_bomb'],
+                code='image_too_large',
+                params={'name': file_upload.name}
+            ) from exc
+        except Exception as exc:
+            raise invalid_error from exc
+        finally:
+            file_upload.seek(0)
+        file_upload.image = image
+        file_upload.content_type = Image.MIME.get(image.format)
+        return file_upload
+
+    def check_image_limits(self, file_upload, image):
+        allowed_formats = settings.IMAGE_ALLOWED_FORMATS
+        if allowed_formats and image.format not in allowed_formats:
+            raise ValidationError(
+                self.error_messages['image_format'],
+                code='image_format',
+                params={'name': file_upload.name, 'format': image.format}
+            )
+        width, height = image.size
+        if (
+            width > settings.IMAGE_MAX_WIDTH
+            or height > settings.IMAGE_MAX_HEIGHT
+            or width * height > settings.IMAGE_MAX_PIXELS
+        ):
+            raise ValidationError(
+                self.error_messages['image_too_large'],
+                code='image_too_large',
+                params={
+                    'name': file_upload.name, 'width': width, 'height': height
+                }
+            )
+
+
+class ImagesArrayFilesInputField(ImageCheckMixin, FilesArrayFilesInputField,
+                                 ImageField):
     """Поле формы для загрузки нескольких изображений в админке."""
     def to_python(self, data):
         if data in self.empty_values:
             return
         data = super(ImagesArrayFilesInputField, self).to_python(data)
         for file_upload in data:
-            if hasattr(data, 'temporary_file_path'):
-                file = file_upload.temporary_file_path()
-            else:
-                if hasattr(file_upload, 'read'):
-                    file = io.BytesIO(file_upload.read())
-                else:
-                    file = io.BytesIO(file_upload['content'])
-            try:
-                image = Image.open(file)
-                image.verify()
-                file_upload.image = image
-                file_upload.content_type = Image.MIME.get(image.format)
-            except Exception as exc:
-                raise ValidationError(
-                    self.error_messages['invalid_image'],
-                    code='invalid_image',
-                ) from exc
-            if hasattr(file_upload, 'seek') and callable(file_upload.seek):
-                file_upload.seek(0)
+            self.check_image(file_upload, ValidationError(
+                self.error_messages['invalid_image'],
+                code='invalid_image',
+            ))
         return data
 
 
+class FilesArrayChunkedInputField(FilesArrayFilesInputField):
+    """Поле формы для файлов, загруженных частями."""
+    widget = ChunkedFilesInput(attrs={'multiple': True})
+    default_error_messages = {
+        'upload_not_found': 'Загрузка файла не найдена или не завершена, '
+                            'выберите файлы снова.',
+    }
+
+    def to_python(self, data):
+        if data in self.empty_values:
+            return
+        try:
+            ids = [uuid.UUID(session_id) for session_id in data]
+        except ValueError:
+            raise ValidationError(
+                self.error_messages['upload_not_found'],
+                code='upload_not_found'
+            )
+        sessions = UploadSession.objects.in_bulk(ids)
+        if any(
+            session_id not in sessions or not sessions[session_id].completed
+            for session_id in ids
+        ):
+            raise ValidationError(
+                self.error_messages['upload_not_found'],
+                code='upload_not_found'
+            )
+        files = []
+        try:
+            for session_id in ids:
+                try:
+                    files.append(UploadSessionFile(sessions[session_id]))
+                except FileNotFoundError:
+                    # части уже удалены задачей очистки
+                    raise ValidationError(
+                        self.error_messages['upload_not_found'],
+                        code='upload_not_found'
+                    )
+            return super().to_python(files)
+        except Exception:
+            for file in files:
+                file.close()
+            raise
+
+
+class ImagesArrayChunkedInputField(FilesArrayChunkedInputField,
+                                   ImagesArrayFilesInputField):
+    """Поле формы для изображений, загруженных частями."""
+
+
 class FilesArrayURLField(FilesArrayFilesInputField):
     """Поле формы для загрузки нескольких файлов по ссылкам в админке."""
     widget = Textarea(attrs={'cols': '100'})
+    # результаты загрузки, полученные формой заранее общей пачкой
+    prefetched = None
+    default_error_messages = {
+        'invalid_url': 'Некорректная ссылка: %(url)s',
+        'fetch_failed': 'Не удалось загрузить файл по ссылке %(url)s: '
+                        '%(reason)s',
+    }
 
     def to_python(self, data):
         if data in self.empty_values:
             return
-        data = list(map(str.strip, data.split('\n')))
-        files_data = []
-        for file_upload in data:
-            if not file_upload.startswith('http'):
-                raise ValidationError(self.error_messages['invalid'], code='invalid')
-            response = requests.get(file_upload)
-            if response.status_code != 200:
-                raise ValidationError(self.error_messages['invalid'], code='invalid')
-            filename = file_upload.split('/')[-1]
-            try:
-                file = io.BytesIO(response.content)
-                file_upload = InMemoryUploadedFile(
-                    file, 'FileField',
-                    filename,
-                    'image/jpeg',
-                    sys.getsizeof(file),
-                    None
-                )
-                files_data.append(file_upload)
-            except Exception as exc:
-                raise ValidationError(
-                    self.error_messages['invalid'],
-                    code='invalid',
-                ) from exc
-            if hasattr(file_upload, 'seek') and callable(file_upload.seek):
-                file_upload.seek(0)
+        files_data, errors = self.download_files(self.parse_urls(data))
+        if errors:
+            raise ValidationError(errors)
         return files_data
 
+    def parse_urls(self, data):
+        """Разбивает текст на ссылки и проверяет их формат."""
+        urls = [url for url in map(str.strip, data.split('\n')) if url]
+        errors = [
+            ValidationError(
+                self.error_messages['invalid_url'],
+                code='invalid_url',
+                params={'url': url}
+            )
+            for url in urls
+            if urlparse(url).scheme not in ('http', 'https')
+        ]
+        if errors:
+            raise ValidationError(errors)
+        return urls
 
-class ImagesArrayURLField(FilesArrayURLField):
-    """Поле формы для загрузки нескольких изображений по ссылкам в админке."""
-    def to_python(self, data):
-        if data in self.empty_values:
-            return
-        data = list(map(str.strip, data.split('\n')))
+    def download_files(self, urls):
+        """
+        Скачивает и проверяет файлы по ссылкам.
+        Возвращает список файлов и список ошибок по отдельным ссылкам.
+        """
         files_data = []
-        for file_upload in data:
-            if not file_upload.startswith('http'):
-                raise ValidationError(
-                    self.error_messages['invalid'],
-                    code='invalid'
-                )
-            response = requests.get(file_upload)
-            if response.status_code != 200:
-                raise ValidationError(
-                    self.error_messages['invalid'],
-                    code='invalid'
-                )
-            filename = file_upload.split('/')[-1]
+        errors = []
+        results, self.prefetched = self.prefetched, None
+        if results is None or [result.url for result in results] != urls:
+            if results is not None:
+                close_results(results)
+            results = fetch_urls(urls)
+        for result in results:
+            if result.error:
+                errors.append(ValidationError(
+                    self.error_messages['fetch_failed'],
+                    code='fetch_failed',
+                    params={'url': result.url, 'reason': result.error}
+                ))
+                continue
             try:
-                file = io.BytesIO(response.content)
-                image = Image.open(file)
-                image.verify()
-                content_type = Image.MIME.get(image.format)
-                file_upload = InMemoryUploadedFile(
-                    file, 'ImageField',
-                    filename,
-                    content_type,
-                    sys.getsizeof(file),
-                    None
-                )
-                file_upload.image = image
-                file_upload.content_type = content_type
-                files_data.append(file_upload)
-            except Exception as exc:
-                raise ValidationError(
-                    self.error_messages['invalid_image'],
-                    code='invalid_image',
-                ) from exc
-            if hasattr(file_upload, 'seek') and callable(file_upload.seek):
-                file_upload.seek(0)
-        return files_data
+                files_data.append(self.check_url_file(result.url, result.file))
+            except ValidationError as exc:
+                result.file.close()
+                errors.append(exc)
+        return files_data, errors
+
+    def check_url_file(self, url, file_upload):
+        """Проверка скачанного файла. Дополняется в наследниках."""
+        return self.check_file_type(file_upload)
+
+
+class ImagesArrayURLField(ImageCheckMixin, FilesArrayURLField):
+    """Поле формы для загрузки нескольких изображений по ссылкам в админке."""
+    default_error_messages = {
+        'invalid_image_url': 'Файл по ссылке %(url)s не является '
+                             'изображением или повреждён.',
+    }
+
+    def check_url_file(self, url, file_upload):
+        file_upload = super().check_url_file(url, file_upload)
+        return self.check_image(file_upload, ValidationError(
+            self.error_messages['invalid_image_url'],
+            code='invalid_image_url',
+            params={'url': url}
+        ))
 
 
 class FilesArrayField(forms.Field):
     FILES_INPUT_FIELD = FilesArrayFilesInputField
     URL_INPUT_FIELD = FilesArrayURLField
+    CHUNKED_INPUT_FIELD = FilesArrayChunkedInputField
 
-    def __init__(self, use_url=False, *args, **kwargs):
+    def __init__(self, use_url=False, async_import=False, chunked=False,
+                 incremental=True, *args, **kwargs):
+        assert use_url or not async_import, \
+            'Фоновый импорт доступен только при загрузке по ссылкам'
         self.use_url = use_url
+        self.async_import = async_import
+        self.chunked = chunked
+        self.incremental = incremental
         if self.use_url:
             field_class = self.URL_INPUT_FIELD
             self.widget = URLTextarea(attrs={'cols': '100'})
+        elif self.chunked:
+            field_class = self.CHUNKED_INPUT_FIELD
+            self.widget = ChunkedFilesInput(attrs={'multiple': True})
         else:
             field_class = self.FILES_INPUT_FIELD
             self.widget = ClearableMultipleFilesInput(attrs={'multiple': True})
+        if self.incremental:
+            # новые файлы дописываются, текущие можно удалить и переставить
+            self.widget = FilesArrayEditInput(self.widget)
         self.field = field_class(*args, **kwargs)
         super(FilesArrayField, self).__init__(*args, **kwargs)
 
     def to_python(self, value):
+        if self.async_import:
+            # файлы скачает задача celery, здесь проверяются только ссылки
+            if value in self.empty_values:
+                return
+            return self.field.parse_urls(value)
         return self.field.to_python(value)
 
+    def has_changed(self, initial, data):
+        # to_python скачивает и проверяет файлы, повторять это не нужно
+        return not self.disabled and bool(data)
+
 
 class ImagesArrayField(FilesArrayField):
     FILES_INPUT_FIELD = ImagesArrayFilesInputField
     URL_INPUT_FIELD = ImagesArrayURLField
+    CHUNKED_INPUT_FIELD = ImagesArrayChunkedInputField
 
     def widget_attrs(self, widget):
         attrs = super().widget_attrs(widget)
-        if isinstance(widget, ClearableFileInput):
+        if isinstance(getattr(widget, 'widget', widget), ClearableFileInput):
             attrs.setdefault('accept', 'image/*')
         return attrs
+
+
+def files_input_field_for(model_field):
+    """Поле загрузки файлов с устройства для массива файлов модели."""
+    if isinstance(model_field.base_field, models.ImageField):
+        return ImagesArrayFilesInputField()
+    return FilesArrayFilesInputField()
+
+
+def url_input_field_for(model_field):
+    """Поле загрузки по ссылкам для массива файлов модели."""
+    if isinstance(model_field.base_field, models.ImageField):
+        return ImagesArrayURLField()
+    return FilesArrayURLField()
@@ -0,0 +1,108 @@
+"""
+URL файлов из массивов с кэшированием.
+Для сторонних хранилищ storage.url() может быть дорогим
+(подписанные ссылки, запросы к API), поэтому URL хранятся в кэше
+STORAGE_URL_CACHE, а для массива или целой страницы списка
+запрашиваются одним get_many. На прогретом кэше обращений
+к хранилищу нет.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.storage import default_storage
+
+RESOLVER_ATTRIBUTE = '_file_url_resolver'
+
+
+class FileURLResolver:
+    """
+    Получает URL файлов хранилища пачками.
+    Полученные URL запоминаются в экземпляре, поэтому один резолвер
+    удобно использовать на время запроса.
+    """
+    def __init__(self, storage=None, cache_alias=None, timeout=None):
+        self.storage = storage or default_storage
+        self.cache = caches[cache_alias or settings.STORAGE_URL_CACHE]
+        self.timeout = timeout or settings.STORAGE_URL_CACHE_TIMEOUT
+        self.urls = {}
+
+    @staticmethod
+    def cache_key(path):
+        digest = hashlib.md5(path.encode()).hexdigest()
+        return f'file-url:{digest}'
+
+    def prefetch(self, paths):
+        """Получает URL путей одним обращением к кэшу."""
+        missing = {
+            self.cache_key(path): path
+            for path in paths if path and path not in self.urls
+        }
+        if not missing:
+            return
+        cached = self.cache.get_many(list(missing))
+        for key, url in cached.items():
+            self.urls[missing[key]] = url
+        resolved = {
+            key: self.storage.url(path)
+            for key, path in missing.items() if key not in cached
+        }
+        if resolved:
+            self.cache.set_many(resolved, self.timeout)
+            for key, url in resolved.items():
+                self.urls[missing[key]] = url
+
+    def url(self, path):
+        if path not in self.urls:
+            self.prefetch([path])
+        return self.urls[path]
+
+    def urls_for(self, paths):
+        """URL путей в исходном порядке."""
+        paths = list(paths)
+        self.prefetch(paths)
+        return [self.urls[path] for path in paths]
+
+    def forget(self, paths):
+        """Убирает URL удалённых файлов из кэша."""
+        for path in paths:
+            self.urls.pop(path, None)
+        self.cache.delete_many([self.cache_key(path) for path in paths])
+
+
+def get_request_resolver(request=None):
+    """Резолвер, общий для всего запроса (или новый, если запроса нет)."""
+    if request is None:
+        return FileURLResolver()
+    resolver = getattr(request, RESOLVER_ATTRIBUTE, None)
+    if resolver is None:
+        resolver = FileURLResolver()
+        setattr(request, RESOLVER_ATTRIBUTE, resolver)
+    return resolver
+
+
+def prefetch_file_urls(objects, field_names, resolver=None):
+    """
+    Получает URL файлов из массивов field_names всех объектов
+    одним обращением к кэшу и привязывает резолвер к объектам.
+    """
+    objects = list(objects)
+    resolver = resolver or FileURLResolver()
+    resolver.prefetch(
+        path
+        for instance in objects
+        for field_name in field_names
+        for path in getattr(instance, field_name, None) or []
+    )
+    for instance in objects:
+        bind_resolver(instance, resolver)
+    return resolver
+
+
+def bind_resolver(instance, resolver):
+    setattr(instance, RESOLVER_ATTRIBUTE, resolver)
+
+
+def get_resolver(instance):
+    """Резолвер, привязанный к объекту prefetch_file_urls, или новый."""
+    return getattr(instance, RESOLVER_ATTRIBUTE, None) or FileURLResolver()
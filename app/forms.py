@@ -1,32 +1,52 @@
-import os
-import random
+from collections import defaultdict
 
 from django import forms
-from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres.forms import SimpleArrayField
-from django.core.files.storage import default_storage
+from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.forms import ImageField
-from slugify import slugify
 
+from app import metrics
+from app.fetcher import fetch_urls
 from app.fields import FilesArrayField, ImagesArrayField
-from app.models import ModelWithFilesArray, ModelWithImagesArray
-from app.tasks import delete_old_files_from_storage
-from app.utils import is_cyrillic
+from app.metadata import (METADATA_FIELD, collect_metadata, has_metadata,
+                          metadata_expression)
+from app.models import (FilesImportJob, ModelWithFilesArray,
+                        ModelWithImagesArray, StoredFile, UploadSession)
+from app.renditions import (RENDITIONS_FIELD, drop_renditions_expression,
+                            has_renditions, schedule_renditions)
+from app.storage import save_arrays
+from app.tasks import import_files_from_urls, schedule_files_deletion
+from app.utils import array_edit_expression
 
 
 class WithArrayAbstractModelForm(forms.ModelForm):
     """
     Абстрактный класс с методами для массивов с файлами.
-    Пока что поддерживает только один массив файлов на модель.
+    Обрабатывает все массивы файлов модели: файлы по ссылкам
+    скачиваются, а новые файлы сохраняются общей параллельной пачкой,
+    все массивы записываются одним UPDATE, а ненужные файлы
+    отправляются на удаление одной задачей.
     """
     def __init__(self, *args, **kwargs):
         super(WithArrayAbstractModelForm, self).__init__(*args, **kwargs)
-        self.FILES_ARRAY_FIELD, field = self.get_file_field()
-        assert field, 'В модели отсутствует массив файлов'
-        self.old_array = self.initial.get(self.FILES_ARRAY_FIELD, [])
-        self.fields[self.FILES_ARRAY_FIELD] = field
+        file_fields = self.get_file_fields()
+        assert file_fields, 'В модели отсутствует массив файлов'
+        self.FILES_ARRAY_FIELDS = list(file_fields)
+        self.old_arrays = {}
+        self.import_urls = {}
+        self.new_images = []
+        self.refresh_fields = []
+        for field_name, field in file_fields.items():
+            self.old_arrays[field_name] = self.initial.get(field_name) or []
+            self.fields[field_name] = field
+            if field.incremental:
+                field.widget.entries = self.old_arrays[field_name]
 
-    def get_file_field(self):
+    def get_file_fields(self):
+        """Поля загрузки для всех массивов файлов формы."""
+        file_fields = {}
         for field_name, field_class in self.fields.items():
             if isinstance(field_class, SimpleArrayField):
                 kwargs = {
@@ -36,63 +56,224 @@ class WithArrayAbstractModelForm(forms.ModelForm):
                     'use_url': False
                 }
                 if isinstance(field_class.base_field, ImageField):
-                    return field_name, ImagesArrayField(**kwargs)
-                return field_name, FilesArrayField(**kwargs)
+                    file_fields[field_name] = ImagesArrayField(**kwargs)
+                else:
+                    file_fields[field_name] = FilesArrayField(**kwargs)
             elif (isinstance(field_class, FilesArrayField) or
                   isinstance(field_class, ImagesArrayField)):
                 kwargs = field_class.__dict__
                 kwargs.pop('field')
-                return field_name, field_class.__class__(**kwargs)
-        return None, None
+                file_fields[field_name] = field_class.__class__(**kwargs)
+        return file_fields
+
+    def _clean_fields(self):
+        with metrics.span('form.clean'):
+            self.prefetch_urls()
+            super()._clean_fields()
+
+    def prefetch_urls(self):
+        """
+        Скачивает файлы по ссылкам всех массивов одной параллельной
+        пачкой, поля затем только проверяют скачанные файлы.
+        """
+        batches = []
+        for field_name in self.FILES_ARRAY_FIELDS:
+            field = self.fields[field_name]
+            if not field.use_url or field.async_import or field.disabled:
+                continue
+            data = self[field_name].data
+            if data in field.empty_values:
+                continue
+            try:
+                urls = field.field.parse_urls(data)
+            except ValidationError:
+                continue
+            batches.append((field.field, urls))
+        if len(batches) < 2:
+            # единственное поле скачает файлы само
+            return
+        results = iter(fetch_urls([url for _, urls in batches for url in urls]))
+        for url_field, urls in batches:
+            url_field.prefetched = [next(results) for _ in urls]
 
     def save(self, commit=True):
-        array = self.cleaned_data.get(self.FILES_ARRAY_FIELD, [])
         instance = super().save(commit=False)
-        if array is None:
-            instance.images = self.initial.get(self.FILES_ARRAY_FIELD, [])
-        delete_old_array = False
-        if array:
-            upload_to = self._meta.model._meta.get_field(
-                self.FILES_ARRAY_FIELD
-            ).base_field.upload_to
-            setattr(instance, self.FILES_ARRAY_FIELD, [])
-            delete_old_array = True
-            for file in array:
-                if callable(upload_to):
-                    file_name = upload_to(instance, file.name)
-                else:
-                    file_name = upload_to + file.name
-                # при работе с дефолтным хранилищем проверку можно удалить
-                file_name = self.check_file_name(file_name)
-                file = default_storage.save(file_name, file)
-                getattr(instance, self.FILES_ARRAY_FIELD).append(file)
+        with metrics.span('form.save_arrays'):
+            removed = self.save_arrays(instance)
         if commit:
             instance.save()
-        if delete_old_array and self.old_array:
-            # если в хранилище есть старые файлы и загружаем новые
-            # отправляем в celery задачу на их удаление
-            delete_old_files_from_storage.apply_async([self.old_array])
+            self._save_m2m()
+            self.schedule_removed_files_deletion(removed)
+        else:
+            # объект сохранит вызывающий код, файлы удаляются после
+            # его save_m2m, как и связи многие-ко-многим
+            save_m2m = self.save_m2m
+
+            def save_m2m_and_delete_files():
+                save_m2m()
+                self.schedule_removed_files_deletion(removed)
+            self.save_m2m = save_m2m_and_delete_files
         return instance
 
-    @staticmethod
-    def check_file_name(file_name):
+    def schedule_removed_files_deletion(self, removed):
+        # из хранилища удаляются только убранные из массивов файлы,
+        # общая задача уходит в celery после фиксации транзакции
+        with transaction.atomic():
+            for with_renditions, files in removed.items():
+                schedule_files_deletion(
+                    StoredFile.objects.release(files), with_renditions
+                )
+
+    def save_arrays(self, instance):
         """
-        Метод проверки имени файла на дубликаты.
-        При работе с дефолтным хранилищем django не нужен.
-        Необходим при работе со сторонними хранилищами,
-        так как в них такая встроенная проверка отсутствует.
+        Сохраняет в хранилище новые файлы всех массивов одной пачкой
+        и записывает в объект новые значения массивов.
+        Возвращает пути ненужных файлов: {with_renditions: пути}.
         """
-        full_path, extension = os.path.splitext(file_name)
-        split_path = full_path.split('/')
-        name = split_path[-1]
-        path = '/'.join(split_path[:-1]) + '/'
-        if is_cyrillic(name):
-            name = slugify(name)
-        file_name = f'{path}{name}{extension}'
-        while default_storage.exists(file_name):
-            suffix = ''.join(random.choices(settings.SYMBOLS, k=5))
-            file_name = f'{path}{name}_{suffix}{extension}'
-        return file_name
+        arrays = {}
+        for field_name in self.FILES_ARRAY_FIELDS:
+            array = self.cleaned_data.get(field_name) or []
+            if self.fields[field_name].async_import:
+                # файлы по ссылкам скачает задача celery
+                # после сохранения объекта
+                if array:
+                    self.import_urls[field_name] = array
+                array = []
+            arrays[field_name] = array
+        new_arrays = save_arrays(instance, arrays)
+        self.discard_upload_sessions(
+            [file for array in arrays.values() for file in array]
+        )
+        removed = defaultdict(list)
+        dropped_renditions = []
+        for field_name, new_array in new_arrays.items():
+            with_renditions = has_renditions(self._meta.model, field_name)
+            if with_renditions:
+                # производные для новых файлов создадут задачи
+                # после сохранения объекта
+                self.new_images.extend(new_array)
+            if self.fields[field_name].incremental:
+                field_removed = self.apply_array_edits(
+                    instance, field_name, new_array
+                )
+            else:
+                field_removed = self.replace_array(
+                    instance, field_name, new_array
+                )
+            if with_renditions:
+                # производные убранных файлов больше не нужны
+                dropped_renditions.extend(
+                    path for path in field_removed if path not in new_array
+                )
+            removed[with_renditions].extend(field_removed)
+        if dropped_renditions:
+            instance.renditions = drop_renditions_expression(
+                dropped_renditions
+            )
+            self.refresh_fields.append(RENDITIONS_FIELD)
+        if has_metadata(self._meta.model):
+            self.save_metadata(instance, arrays, new_arrays, [
+                path for files in removed.values() for path in files
+            ])
+        return {
+            with_renditions: files
+            for with_renditions, files in removed.items() if files
+        }
+
+    def save_metadata(self, instance, arrays, new_arrays, removed):
+        """
+        Записывает метаданные новых файлов, собранные при проверке,
+        и убирает метаданные удалённых.
+        """
+        metadata = {}
+        for field_name, new_array in new_arrays.items():
+            metadata.update(collect_metadata(new_array, arrays[field_name]))
+        if instance._state.adding:
+            setattr(instance, METADATA_FIELD, metadata)
+        elif metadata or removed:
+            setattr(instance, METADATA_FIELD, metadata_expression(
+                [path for path in removed if path not in metadata], metadata
+            ))
+            self.refresh_fields.append(METADATA_FIELD)
+
+    def replace_array(self, instance, field_name, new_array):
+        """Режим замены: новые файлы заменяют весь массив."""
+        old_array = self.old_arrays[field_name]
+        if not new_array:
+            setattr(instance, field_name, old_array)
+            return []
+        setattr(instance, field_name, new_array)
+        return old_array
+
+    def apply_array_edits(self, instance, field_name, appended):
+        """
+        Правит массив на месте: удаляет отмеченные файлы,
+        переставляет оставшиеся и дописывает новые в конец.
+        Значения, которых не было в форме, не затрагиваются.
+        Возвращает удалённые пути, каждый столько раз, сколько он
+        встречался в массиве: array_remove убирает все вхождения,
+        и ссылка освобождается за каждое.
+        """
+        if instance._state.adding:
+            setattr(instance, field_name, appended)
+            return []
+        old_array = self.old_arrays[field_name]
+        removed, order = self.fields[field_name].widget.edits_from_datadict(
+            self.data, self.add_prefix(field_name)
+        )
+        removed = [path for path in removed if path in old_array]
+        if order is not None:
+            order = [
+                path for path in order
+                if path in old_array and path not in removed
+            ]
+        setattr(instance, field_name, array_edit_expression(
+            self._meta.model._meta.get_field(field_name),
+            removed, order, appended
+        ))
+        # после сохранения в объекте выражение, а не значение
+        self.refresh_fields.append(field_name)
+        return [path for path in old_array if path in removed]
+
+    @staticmethod
+    def discard_upload_sessions(array):
+        """Сессии загрузки частями больше не нужны после сохранения файлов."""
+        sessions = [
+            file.session.pk for file in array if hasattr(file, 'session')
+        ]
+        if sessions:
+            transaction.on_commit(
+                lambda: UploadSession.objects.discard(sessions)
+            )
+
+    def _save_m2m(self):
+        super()._save_m2m()
+        if self.refresh_fields:
+            self.instance.refresh_from_db(fields=self.refresh_fields)
+            self.refresh_fields = []
+        if self.new_images:
+            instance, paths = self.instance, self.new_images
+            self.new_images = []
+            transaction.on_commit(
+                lambda: schedule_renditions(instance, paths)
+            )
+        if self.import_urls:
+            # создаём задания только после сохранения объекта,
+            # так как при commit=False у нового объекта ещё нет pk
+            content_type = ContentType.objects.get_for_model(self.instance)
+            jobs = FilesImportJob.objects.bulk_create([
+                FilesImportJob(
+                    content_type=content_type,
+                    object_id=self.instance.pk,
+                    field_name=field_name,
+                    urls=urls
+                )
+                for field_name, urls in self.import_urls.items()
+            ])
+            self.import_urls = {}
+            transaction.on_commit(lambda: [
+                import_files_from_urls.apply_async([job.pk]) for job in jobs
+            ])
 
 
 class ModelWithImagesArrayForm(WithArrayAbstractModelForm):
@@ -111,7 +292,7 @@ class ModelWithImagesArrayForm(WithArrayAbstractModelForm):
 class ModelWithFilesArrayForm(WithArrayAbstractModelForm):
     files = FilesArrayField(
         label='Загрузить файлы',
-        help_text='При загрузке новых файлов, старые удаляются!',
+        help_text='Новые файлы добавляются в конец списка',
         required=False
     )
 
@@ -0,0 +1,124 @@
+"""
+Проверка содержимого загруженных файлов за один проход:
+sha256 и тип по сигнатуре (magic bytes) в начале файла.
+Временные файлы на диске отображаются в память (mmap) и хэшируются
+срезами memoryview без копирования, файлы в памяти читаются по частям.
+Результаты сохраняются в атрибутах файла sha256 и sniffed_type
+и используются дальше (имена по хэшу, дедупликация, метаданные).
+Если sha256 уже посчитан при приёме файла (upload_handlers, fetcher),
+читается только заголовок.
+"""
+import hashlib
+import mmap
+
+from app import metrics
+
+# сколько байт начала файла нужно для определения типа
+HEADER_SIZE = 512
+# размер среза при хэшировании mmap
+MMAP_SLICE_SIZE = 8 * 1024 * 1024
+
+OCTET_STREAM = 'application/octet-stream'
+
+# (смещение, сигнатура, тип)
+MAGIC_SIGNATURES = [
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (8, b'WEBP', 'image/webp'),
+    (0, b'BM', 'image/bmp'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+    (0, b'\x00\x00\x01\x00', 'image/vnd.microsoft.icon'),
+    (0, b'%PDF-', 'application/pdf'),
+    (0, b'PK\x03\x04', 'application/zip'),
+    (0, b'PK\x05\x06', 'application/zip'),
+    (0, b'\x1f\x8b', 'application/gzip'),
+    (0, b'7z\xbc\xaf\x27\x1c', 'application/x-7z-compressed'),
+    (0, b'Rar!\x1a\x07', 'application/vnd.rar'),
+    (0, b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'application/x-ole-storage'),
+    (4, b'ftyp', 'video/mp4'),
+    (0, b'\x1aE\xdf\xa3', 'video/webm'),
+    (0, b'OggS', 'audio/ogg'),
+    (0, b'ID3', 'audio/mpeg'),
+    (0, b'fLaC', 'audio/flac'),
+]
+
+
+def sniff_type(header):
+    """Тип файла по сигнатуре в его начале."""
+    for offset, signature, content_type in MAGIC_SIGNATURES:
+        if header[offset:offset + len(signature)] == signature:
+            if content_type == 'image/webp' and header[:4] != b'RIFF':
+                continue
+            return content_type
+    if not header:
+        return OCTET_STREAM
+    if b'\x00' not in header:
+        try:
+            # многобайтный символ может быть обрезан концом заголовка
+            header.decode('utf-8')
+        except UnicodeDecodeError as exc:
+            if exc.start < len(header) - 3:
+                return OCTET_STREAM
+        return 'text/plain'
+    return OCTET_STREAM
+
+
+def is_type_allowed(content_type, allowed_types):
+    """Тип из списка разрешённых; поддерживаются маски вида image/*."""
+    if not allowed_types:
+        return True
+    main_type = content_type.split('/')[0]
+    return any(
+        allowed == content_type or allowed == f'{main_type}/*'
+        for allowed in allowed_types
+    )
+
+
+def inspect_file(file):
+    """
+    Считает sha256 и определяет тип файла, записывая их в атрибуты
+    sha256 и sniffed_type. Повторно файл не читается.
+    """
+    if getattr(file, 'sniffed_type', None):
+        return file
+    with metrics.span('file.inspect'):
+        if getattr(file, 'sha256', None):
+            file.seek(0)
+            header = file.read(HEADER_SIZE)
+        elif hasattr(file, 'temporary_file_path') and file.size:
+            header, file.sha256 = _inspect_path(file.temporary_file_path())
+        else:
+            header, file.sha256 = _inspect_chunks(file)
+        file.seek(0)
+    file.sniffed_type = sniff_type(bytes(header))
+    metrics.incr('inspected_bytes', file.size or 0)
+    return file
+
+
+def _inspect_path(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source, mmap.mmap(
+        source.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mapped:
+        view = memoryview(mapped)
+        try:
+            for start in range(0, len(view), MMAP_SLICE_SIZE):
+                digest.update(view[start:start + MMAP_SLICE_SIZE])
+            header = bytes(view[:HEADER_SIZE])
+        finally:
+            view.release()
+    return header, digest.hexdigest()
+
+
+def _inspect_chunks(file):
+    digest = hashlib.sha256()
+    header = b''
+    file.seek(0)
+    for chunk in file.chunks():
+        if len(header) < HEADER_SIZE:
+            header += chunk[:HEADER_SIZE - len(header)]
+        digest.update(chunk)
+    return header, digest.hexdigest()
@@ -0,0 +1,169 @@
+from datetime import timedelta
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from app.models import StoredFile
+from app.storage import delete_files
+from app.utils import BloomFilter, find_file_usages, get_file_array_fields
+
+
+class Command(BaseCommand):
+    help = (
+        'Поиск файлов в хранилище, на которые нет ссылок в массивах файлов. '
+        'По умолчанию только выводит отчёт, с --delete удаляет найденное.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--delete', action='store_true',
+            help='Удалить найденные файлы.'
+        )
+        parser.add_argument(
+            '--prefix', action='append', dest='prefixes',
+            help='Каталог хранилища для проверки (можно указать несколько). '
+                 'По умолчанию - каталоги upload_to массивов файлов.'
+        )
+        parser.add_argument(
+            '--min-age', type=float, default=24,
+            help='Не трогать файлы моложе указанного числа часов: '
+                 'они могут принадлежать ещё не сохранённым объектам.'
+        )
+        parser.add_argument(
+            '--exact', action='store_true',
+            help='Хранить ссылки в точном множестве вместо фильтра Блума.'
+        )
+        parser.add_argument(
+            '--error-rate', type=float, default=0.0001,
+            help='Доля ложных совпадений фильтра Блума.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Размер пачки при чтении из БД и удалении файлов.'
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        fields = list(get_file_array_fields())
+        referenced = self.collect_references(fields, options)
+        prefixes = options['prefixes'] or self.get_default_prefixes(fields)
+        min_modified = timezone.now() - timedelta(hours=options['min_age'])
+        checked = 0
+        orphans = []
+        deleted = 0
+        for name in self.walk(prefixes):
+            checked += 1
+            if self.is_referenced(name, referenced):
+                continue
+            if default_storage.get_modified_time(name) > min_modified:
+                continue
+            orphans.append(name)
+            if self.verbosity > 1:
+                self.stdout.write(name)
+            if options['delete'] and len(orphans) >= options['batch_size']:
+                deleted += self.delete(orphans)
+                orphans = []
+        if options['delete']:
+            deleted += self.delete(orphans)
+            self.stdout.write(
+                f'Проверено файлов: {checked}, удалено: {deleted}.'
+            )
+        else:
+            self.stdout.write(
+                f'Проверено файлов: {checked}, без ссылок: {len(orphans)}.'
+            )
+
+    def collect_references(self, fields, options):
+        """
+        Читает все пути из массивов файлов серверным курсором
+        (unnest в postgres), не создавая объектов моделей.
+        """
+        with connection.cursor() as cursor:
+            total = 0
+            for model, field in fields:
+                cursor.execute(
+                    f'SELECT COALESCE(SUM(CARDINALITY("{field.column}")), 0) '
+                    f'FROM "{model._meta.db_table}"'
+                )
+                total += cursor.fetchone()[0]
+        if options['exact']:
+            referenced = set()
+        else:
+            referenced = BloomFilter(total, options['error_rate'])
+        for model, field in fields:
+            with connection.chunked_cursor() as cursor:
+                cursor.itersize = options['batch_size']
+                cursor.execute(
+                    f'SELECT UNNEST("{field.column}") '
+                    f'FROM "{model._meta.db_table}"'
+                )
+                for (name,) in cursor:
+                    if name:
+                        referenced.add(name)
+        if self.verbosity > 1:
+            self.stdout.write(f'Ссылок на файлы в БД: {total}.')
+        return referenced
+
+    @staticmethod
+    def get_default_prefixes(fields):
+        prefixes = set()
+        for model, field in fields:
+            upload_to = field.base_field.upload_to
+            if callable(upload_to):
+                try:
+                    upload_to = upload_to(model(), '')
+                except Exception:
+                    continue
+            prefixes.add(upload_to.rsplit('/', 1)[0])
+        return sorted(prefixes)
+
+    def walk(self, prefixes):
+        """Постранично (по каталогам) обходит файлы хранилища."""
+        stack = list(prefixes)
+        while stack:
+            directory = stack.pop()
+            try:
+                directories, files = default_storage.listdir(directory)
+            except FileNotFoundError:
+                continue
+            for name in files:
+                yield f'{directory}/{name}' if directory else name
+            stack.extend(
+                f'{directory}/{name}' if directory else name
+                for name in directories
+            )
+
+    @staticmethod
+    def get_original_name(name):
+        if '/renditions/' in name:
+            # производная нужна, пока есть ссылка на оригинал:
+            # каталог/renditions/имя/файл.расширение.формат
+            directory, rendition = name.split('/renditions/', 1)
+            file_name = rendition.split('/', 1)[-1].rsplit('.', 1)[0]
+            name = f'{directory}/{file_name}'
+        return name
+
+    def is_referenced(self, name, referenced):
+        return self.get_original_name(name) in referenced
+
+    def delete(self, names):
+        # ссылки могли появиться после чтения БД,
+        # поэтому пачка перепроверяется по индексам массивов
+        originals = {name: self.get_original_name(name) for name in names}
+        usages = find_file_usages(originals.values())
+        names = [name for name in names if not usages[originals[name]]]
+        if not names:
+            return 0
+        with transaction.atomic():
+            # при дедупликации старый файл может переиспользовать
+            # сохранение, которое ещё не записало массив: ссылка
+            # в StoredFile уже есть, такие файлы пропускаются
+            released = StoredFile.objects.lock_released(
+                {originals[name] for name in names}
+            )
+            names = [name for name in names if originals[name] in released]
+            if names:
+                delete_files(names)
+        return len(names)
@@ -0,0 +1,417 @@
+import csv
+import json
+import mimetypes
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile, UploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from app import metrics
+from app.fetcher import FetchError, download
+from app.fields import files_input_field_for, url_input_field_for
+from app.metadata import (METADATA_FIELD, file_metadata, has_metadata,
+                          metadata_expression)
+from app.models import StoredFile
+from app.renditions import has_renditions, schedule_renditions
+from app.storage import save_files
+from app.tasks import schedule_files_deletion
+from app.utils import array_edit_expression
+
+
+class LocalFile(UploadedFile):
+    """
+    Файл с диска сервера.
+    Без temporary_file_path: хранилище должно скопировать файл,
+    а не переместить его из каталога импорта.
+    """
+    def __init__(self, path):
+        name = os.path.basename(path)
+        super().__init__(
+            open(path, 'rb'), name, mimetypes.guess_type(name)[0],
+            os.path.getsize(path)
+        )
+
+
+def check_file(model_label, field_name, url, path, data, name, content_type):
+    """
+    Проверка файла полем формы в процессе пула: Pillow и sha256
+    нагружают процессор, и в потоках их ограничивал бы GIL.
+    Файл передаётся путём на диске или содержимым, обратно
+    возвращаются ошибка или атрибуты проверенного файла и метаданные.
+    """
+    model_field = apps.get_model(model_label)._meta.get_field(field_name)
+    if path is not None:
+        file = UploadedFile(
+            open(path, 'rb'), name, content_type, os.path.getsize(path)
+        )
+    else:
+        file = SimpleUploadedFile(name, data, content_type)
+    try:
+        if url:
+            url_input_field_for(model_field).check_url_file(url, file)
+        else:
+            files_input_field_for(model_field).to_python([file])
+    except ValidationError as exc:
+        return ' '.join(exc.messages), None
+    finally:
+        file.close()
+        # процессы пула завершаются без atexit
+        metrics.flush()
+    attributes = {
+        name: getattr(file, name, None)
+        for name in ('sha256', 'sniffed_type', 'content_type')
+    }
+    return None, (attributes, file_metadata(file))
+
+
+class Command(BaseCommand):
+    help = (
+        'Массовый импорт файлов в массивы объектов из манифеста CSV '
+        '(колонки row и source) или JSONL ({"row": ..., "source": ...}). '
+        'row - первичный ключ объекта, source - ссылка или путь к файлу. '
+        'Файлы проверяются полями формы и сохраняются параллельно, '
+        'массивы дописываются пачками, прогресс сохраняется в контрольную '
+        'точку, с которой прерванный импорт продолжается.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('manifest', help='Файл манифеста.')
+        parser.add_argument(
+            'field', help='Массив файлов: app_label.Model.поле.'
+        )
+        parser.add_argument(
+            '--format', choices=['csv', 'jsonl'],
+            help='Формат манифеста. По умолчанию - по расширению файла.'
+        )
+        parser.add_argument(
+            '--base-dir', default='',
+            help='Каталог, относительно которого указаны пути к файлам.'
+        )
+        parser.add_argument(
+            '--create', action='store_true',
+            help='Создавать объекты, которых нет в БД.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Число записей манифеста в одной пачке.'
+        )
+        parser.add_argument(
+            '--workers', type=int, default=settings.URL_FETCH_MAX_WORKERS,
+            help='Число потоков для загрузки и сохранения файлов.'
+        )
+        parser.add_argument(
+            '--processes', type=int, default=os.cpu_count(),
+            help='Число процессов для проверки файлов.'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='Файл контрольной точки. По умолчанию - <манифест>.'
+                 'checkpoint.'
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Начать импорт заново, не учитывая контрольную точку.'
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        self.model, self.field = self.get_field(options['field'])
+        self.create = options['create']
+        self.base_dir = options['base_dir']
+        self.workers = options['workers']
+        self.files_field = files_input_field_for(self.field)
+        self.url_field = url_input_field_for(self.field)
+        self.manifest = options['manifest']
+        self.checkpoint = options['checkpoint'] or (
+            self.manifest + '.checkpoint'
+        )
+        done = 0 if options['restart'] else self.read_checkpoint()
+        if done:
+            self.stdout.write(f'Продолжение импорта с записи {done + 1}.')
+        entries = islice(
+            self.read_manifest(options['manifest'], options['format']),
+            done, None
+        )
+        imported = failed = 0
+        created = False
+        # spawn, а не fork: в процессе уже работают потоки загрузки
+        self.checker = ProcessPoolExecutor(
+            options['processes'], multiprocessing.get_context('spawn'),
+            initializer=django.setup
+        )
+        with self.checker:
+            while True:
+                batch = list(islice(entries, options['batch_size']))
+                if not batch:
+                    break
+                saved, errors, batch_created = self.import_batch(batch, done)
+                done += len(batch)
+                imported += saved
+                failed += len(errors)
+                created = created or batch_created
+                for error in errors:
+                    self.stderr.write(error)
+                self.write_checkpoint(done)
+                if self.verbosity > 1:
+                    self.stdout.write(
+                        f'Обработано записей: {done}, файлов: {imported}.'
+                    )
+        if created:
+            self.reset_sequence()
+        self.stdout.write(
+            f'Импортировано файлов: {imported}, ошибок: {failed}.'
+        )
+
+    @staticmethod
+    def get_field(label):
+        try:
+            model_label, field_name = label.rsplit('.', 1)
+            model = apps.get_model(model_label)
+            field = model._meta.get_field(field_name)
+        except (ValueError, LookupError) as exc:
+            raise CommandError(f'Поле {label} не найдено.') from exc
+        if not isinstance(field, ArrayField):
+            raise CommandError(f'Поле {label} не является массивом файлов.')
+        return model, field
+
+    def read_manifest(self, path, manifest_format=None):
+        """Построчно читает манифест, выдаёт пары (row, source)."""
+        if manifest_format is None:
+            manifest_format = 'jsonl' if path.endswith(
+                ('.jsonl', '.ndjson')
+            ) else 'csv'
+        with open(path, newline='') as file:
+            if manifest_format == 'csv':
+                rows = csv.DictReader(file)
+            else:
+                rows = (json.loads(line) for line in file if line.strip())
+            for number, row in enumerate(rows, 1):
+                try:
+                    yield str(row['row']), str(row['source']).strip()
+                except (KeyError, TypeError) as exc:
+                    raise CommandError(
+                        f'Запись {number} манифеста: нет row или source.'
+                    ) from exc
+
+    def read_checkpoint(self):
+        """
+        Число обработанных записей манифеста. Если импорт прервался
+        между фиксацией пачки и записью контрольной точки (pending),
+        пачка считается записанной, когда в БД есть её файл.
+        """
+        path = self.checkpoint
+        try:
+            with open(path) as file:
+                checkpoint = json.load(file)
+        except FileNotFoundError:
+            return 0
+        except ValueError as exc:
+            raise CommandError(
+                f'Повреждена контрольная точка {path}, '
+                'удалите её или запустите с --restart.'
+            ) from exc
+        if checkpoint.get('manifest') != os.path.abspath(self.manifest):
+            raise CommandError(
+                f'Контрольная точка {path} относится к другому манифесту.'
+            )
+        pending = checkpoint.get('pending')
+        if pending and self.model.objects.filter(**{
+            f'{self.field.name}__contains': [pending['path']]
+        }).exists():
+            return pending['done']
+        return checkpoint['done']
+
+    def write_checkpoint(self, done, pending=None):
+        directory = os.path.dirname(os.path.abspath(self.checkpoint))
+        checkpoint = {'manifest': os.path.abspath(self.manifest), 'done': done}
+        if pending:
+            checkpoint['pending'] = pending
+        with tempfile.NamedTemporaryFile(
+            'w', dir=directory, delete=False
+        ) as file:
+            json.dump(checkpoint, file)
+        os.replace(file.name, self.checkpoint)
+
+    def import_batch(self, batch, done):
+        """
+        Импортирует пачку записей: загружает и проверяет файлы,
+        сохраняет их в хранилище и дописывает в массивы одним bulk_update.
+        done - число записей манифеста, обработанных до пачки.
+        Возвращает число сохранённых файлов, ошибки и признак того,
+        что были созданы новые объекты.
+        """
+        pk_field = self.model._meta.pk
+        errors = []
+        entries = []
+        for row, source in batch:
+            try:
+                entries.append((pk_field.to_python(row), source))
+            except ValidationError:
+                errors.append(f'{row}: некорректный идентификатор объекта')
+        instances = self.model.objects.in_bulk({pk for pk, _ in entries})
+        missing = {pk for pk, _ in entries} - set(instances)
+        created = bool(missing and self.create)
+        if created:
+            self.model.objects.bulk_create(
+                [self.model(pk=pk) for pk in missing], ignore_conflicts=True
+            )
+            instances.update(self.model.objects.in_bulk(missing))
+        elif missing:
+            errors.extend(
+                f'{pk}: объект не найден' for pk, _ in entries
+                if pk in missing
+            )
+            entries = [(pk, source) for pk, source in entries
+                       if pk not in missing]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = list(executor.map(
+                lambda entry: self.load(entry[1]), entries
+            ))
+            files = {}
+            metadata = {}
+            for (pk, source), (loaded, error) in zip(entries, results):
+                if error:
+                    errors.append(f'{pk}: {source}: {error}')
+                else:
+                    files.setdefault(pk, []).append(loaded[0])
+                    metadata.setdefault(pk, []).append(loaded[1])
+            saved = dict(zip(files, executor.map(
+                lambda pk: self.save(instances[pk], files[pk]), files
+            )))
+        for pk, result in saved.items():
+            if isinstance(result, Exception):
+                errors.append(f'{pk}: не удалось сохранить файлы: {result}')
+        saved = {
+            pk: paths for pk, paths in saved.items()
+            if not isinstance(paths, Exception)
+        }
+        try:
+            self.update_rows(
+                instances, metadata, saved, (done, done + len(batch))
+            )
+        except Exception:
+            paths = [path for paths in saved.values() for path in paths]
+            schedule_files_deletion(
+                StoredFile.objects.release(paths),
+                has_renditions(self.model, self.field.name)
+            )
+            raise
+        return sum(map(len, saved.values())), errors, created
+
+    def load(self, source):
+        """
+        Открывает или скачивает файл и проверяет его полем формы
+        в пуле процессов. Возвращает (файл, метаданные) или ошибку.
+        """
+        file = None
+        try:
+            url = None
+            if source.startswith(('http://', 'https://')):
+                url = source
+                file = download(url)
+            else:
+                file = LocalFile(os.path.join(self.base_dir, source))
+            error, checked = self.checker.submit(
+                check_file, self.model._meta.label, self.field.name, url,
+                *self.file_source(file), file.name, file.content_type
+            ).result()
+        except (FetchError, OSError) as exc:
+            error = str(exc)
+        if error:
+            if file is not None:
+                file.close()
+            return None, error
+        attributes, metadata = checked
+        for name, value in attributes.items():
+            setattr(file, name, value)
+        return (file, metadata), None
+
+    @staticmethod
+    def file_source(file):
+        """
+        Путь к файлу на диске (временному, локальному или из кэша
+        загрузок) или содержимое файла в памяти для пула процессов.
+        """
+        if hasattr(file, 'temporary_file_path'):
+            return file.temporary_file_path(), None
+        path = getattr(file.file, 'name', None)
+        if isinstance(path, str) and os.path.isfile(path):
+            return path, None
+        file.seek(0)
+        data = file.read()
+        file.seek(0)
+        return None, data
+
+    def save(self, instance, files):
+        # поток пула не закрывает соединение с БД сам (нужно
+        # для StoredFile при дедупликации)
+        try:
+            return save_files(instance, self.field.name, files)
+        except Exception as exc:
+            return exc
+        finally:
+            for file in files:
+                file.close()
+            connection.close()
+
+    @transaction.atomic
+    def update_rows(self, instances, metadata, saved, progress):
+        """
+        Дописывает файлы в массивы: bulk_update с выражениями array_cat
+        и jsonb || не затирает изменения, сделанные параллельно.
+        Перед фиксацией в контрольную точку пишется один из путей пачки:
+        по нему повторный запуск узнаёт, что пачка уже в БД, и не
+        дописывает её второй раз. progress - число обработанных записей
+        манифеста до пачки и вместе с ней.
+        """
+        if not saved:
+            return
+        fields = [self.field.name]
+        with_metadata = has_metadata(self.model)
+        if with_metadata:
+            fields.append(METADATA_FIELD)
+        objs = []
+        for pk, paths in saved.items():
+            obj = self.model(pk=pk)
+            setattr(obj, self.field.name, array_edit_expression(
+                self.field, appended=paths
+            ))
+            if with_metadata:
+                setattr(obj, METADATA_FIELD, metadata_expression(
+                    merged=dict(zip(paths, metadata[pk]))
+                ))
+            objs.append(obj)
+        self.model.objects.bulk_update(objs, fields)
+        done, pending_done = progress
+        self.write_checkpoint(done, pending={
+            'done': pending_done,
+            'path': next(path for paths in saved.values() for path in paths)
+        })
+        if has_renditions(self.model, self.field.name):
+            for pk, paths in saved.items():
+                transaction.on_commit(
+                    lambda pk=pk, paths=paths: schedule_renditions(
+                        instances[pk], paths
+                    )
+                )
+
+    def reset_sequence(self):
+        """Созданные с явным ключом объекты не сдвигают последовательность."""
+        statements = connection.ops.sequence_reset_sql(
+            no_style(), [self.model]
+        )
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
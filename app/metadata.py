@@ -0,0 +1,53 @@
+"""
+Метаданные файлов массивов: размер, тип, размеры изображения и sha256.
+Хранятся в поле files_metadata модели рядом с массивами путей:
+{путь: {'size': ..., 'content_type': ..., 'width': ..., 'height': ...,
+'sha256': ...}}.
+Заполняются из уже проверенных при загрузке файлов, поэтому
+для вывода размеров и srcset файлы из хранилища не читаются.
+"""
+from app.utils import jsonb_edit_expression
+
+METADATA_FIELD = 'files_metadata'
+
+
+def has_metadata(model):
+    """Есть ли в модели поле для метаданных файлов."""
+    return any(field.name == METADATA_FIELD for field in model._meta.fields)
+
+
+def file_metadata(file):
+    """Метаданные загруженного файла, собранные при его проверке."""
+    metadata = {
+        'size': file.size,
+        # тип по содержимому надёжнее заявленного клиентом
+        'content_type': (
+            getattr(file, 'sniffed_type', None)
+            or getattr(file, 'content_type', None)
+        ),
+        'sha256': getattr(file, 'sha256', None),
+    }
+    image = getattr(file, 'image', None)
+    if image is not None:
+        metadata['width'], metadata['height'] = image.size
+    return {key: value for key, value in metadata.items() if value}
+
+
+def collect_metadata(paths, files):
+    """Метаданные сохранённых файлов по их путям в хранилище."""
+    return {
+        path: file_metadata(file) for path, file in zip(paths, files)
+    }
+
+
+def merge_metadata(model, pk, metadata):
+    """Атомарно дописывает метаданные файлов в объект (jsonb ||)."""
+    return model.objects.filter(pk=pk).update(**{
+        METADATA_FIELD: jsonb_edit_expression(METADATA_FIELD, merged=metadata)
+    })
+
+
+def metadata_expression(removed=(), merged=None):
+    """Выражение, убирающее метаданные удалённых и добавляющее новые."""
+    return jsonb_edit_expression(METADATA_FIELD, removed, merged)
+
@@ -0,0 +1,316 @@
+"""
+Метрики загрузки и сохранения файлов: замеры времени этапов (span)
+и счётчики (байты, файлы, повторы, коллизии имён).
+
+Значения передаются экспортёрам из настройки METRICS_EXPORTERS:
+RedisPrometheusExporter копит их в Redis, общем для всех воркеров
+gunicorn и celery, и отдаёт в текстовом формате Prometheus
+(app.views.metrics), PrometheusExporter делает то же в памяти
+одного процесса, LogExporter (для отладки) пишет каждое значение
+в лог app.metrics.
+
+Дополнительно значения копятся в сводке текущего запроса (collect),
+которую админка показывает сообщением при DEBUG.
+"""
+import atexit
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('app.metrics')
+
+PREFIX = 'array_files'
+
+_summary = contextvars.ContextVar('array_files_metrics', default=None)
+_exporters = None
+_exporters_lock = threading.Lock()
+
+
+class Summary:
+    """Сводка метрик одного запроса или задачи."""
+    def __init__(self):
+        self.spans = defaultdict(lambda: [0, 0.0])
+        self.counters = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def add_span(self, name, seconds):
+        with self.lock:
+            self.spans[name][0] += 1
+            self.spans[name][1] += seconds
+
+    def add_counter(self, name, value):
+        with self.lock:
+            self.counters[name] += value
+
+    def __bool__(self):
+        return bool(self.spans or self.counters)
+
+    def format(self):
+        spans = ', '.join(
+            f'{name}: {seconds * 1000:.0f} мс'
+            + (f' ({count})' if count > 1 else '')
+            for name, (count, seconds) in sorted(self.spans.items())
+        )
+        counters = ', '.join(
+            f'{name}: {value:g}'
+            for name, value in sorted(self.counters.items())
+        )
+        return '; '.join(part for part in (spans, counters) if part)
+
+
+class PrometheusExporter:
+    """
+    Метрики процесса в памяти для выгрузки в формате Prometheus.
+    У каждого процесса (воркер gunicorn, celery) свои значения.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = defaultdict(lambda: [0, 0.0, 0.0])
+        self.counters = defaultdict(float)
+
+    def record_span(self, name, seconds):
+        with self.lock:
+            span = self.spans[name]
+            span[0] += 1
+            span[1] += seconds
+            span[2] = max(span[2], seconds)
+
+    def record_counter(self, name, value):
+        with self.lock:
+            self.counters[name] += value
+
+    def snapshot(self):
+        """Замеры {имя: [число, сумма, максимум]} и счётчики {имя: число}."""
+        with self.lock:
+            return (
+                {name: list(span) for name, span in self.spans.items()},
+                dict(self.counters)
+            )
+
+    def render(self):
+        spans, counters = self.snapshot()
+        lines = []
+        if spans:
+            lines.extend([
+                f'# TYPE {PREFIX}_span_seconds summary',
+                f'# TYPE {PREFIX}_span_seconds_max gauge',
+            ])
+        for name, (count, total, maximum) in sorted(spans.items()):
+            labels = f'{{span="{name}"}}'
+            lines.extend([
+                f'{PREFIX}_span_seconds_count{labels} {count:g}',
+                f'{PREFIX}_span_seconds_sum{labels} {total:.6f}',
+                f'{PREFIX}_span_seconds_max{labels} {maximum:.6f}',
+            ])
+        for name, value in sorted(counters.items()):
+            lines.extend([
+                f'# TYPE {PREFIX}_{name}_total counter',
+                f'{PREFIX}_{name}_total {value:g}',
+            ])
+        return '\n'.join(lines) + '\n'
+
+
+class RedisPrometheusExporter(PrometheusExporter):
+    """
+    Метрики всех процессов в Redis кэша METRICS_REDIS_CACHE: счётчики
+    и суммы - в хэше (HINCRBYFLOAT), максимумы - в сортированном
+    множестве (ZADD GT). Значения копятся в памяти процесса и
+    отправляются одной пачкой команд (flush) в конце запроса или задачи
+    celery и не реже раза в METRICS_FLUSH_INTERVAL секунд.
+    Если кэш не django-redis (например, locmem в разработке),
+    метрики копятся в памяти процесса, как в PrometheusExporter.
+    """
+    key = f'{PREFIX}:metrics'
+    max_key = f'{PREFIX}:metrics:span_max'
+
+    def __init__(self):
+        super().__init__()
+        self.buffer = PrometheusExporter()
+        self.flushed_at = time.monotonic()
+        try:
+            from django_redis import get_redis_connection
+            self.redis = get_redis_connection(settings.METRICS_REDIS_CACHE)
+        except (ImportError, NotImplementedError):
+            logger.warning(
+                'Кэш %s не использует Redis, метрики хранятся в памяти '
+                'процесса', settings.METRICS_REDIS_CACHE
+            )
+            self.redis = None
+
+    def record_span(self, name, seconds):
+        if self.redis is None:
+            return super().record_span(name, seconds)
+        with self.lock:
+            self.buffer.record_span(name, seconds)
+        self.flush_if_due()
+
+    def record_counter(self, name, value):
+        if self.redis is None:
+            return super().record_counter(name, value)
+        with self.lock:
+            self.buffer.record_counter(name, value)
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        # долгие задачи и команды отправляют метрики, не дожидаясь конца
+        interval = settings.METRICS_FLUSH_INTERVAL
+        if time.monotonic() - self.flushed_at >= interval:
+            self.flush()
+
+    def flush(self):
+        """Отправляет накопленные значения в Redis одной пачкой."""
+        if self.redis is None:
+            return
+        with self.lock:
+            buffer, self.buffer = self.buffer, PrometheusExporter()
+            self.flushed_at = time.monotonic()
+        spans, counters = buffer.snapshot()
+        if not spans and not counters:
+            return
+        pipeline = self.redis.pipeline(transaction=False)
+        for name, (count, total, maximum) in spans.items():
+            pipeline.hincrby(self.key, f'span_count:{name}', count)
+            pipeline.hincrbyfloat(self.key, f'span_sum:{name}', total)
+            pipeline.zadd(self.max_key, {name: maximum}, gt=True)
+        for name, value in counters.items():
+            pipeline.hincrbyfloat(self.key, f'counter:{name}', value)
+        # недоступность Redis не должна ломать загрузку файлов
+        try:
+            pipeline.execute()
+        except Exception as exc:
+            logger.warning('Не удалось записать метрики в Redis: %s', exc)
+
+    def snapshot(self):
+        if self.redis is None:
+            return super().snapshot()
+        self.flush()
+        pipeline = self.redis.pipeline(transaction=False)
+        pipeline.hgetall(self.key)
+        pipeline.zrange(self.max_key, 0, -1, withscores=True)
+        values, maximums = pipeline.execute()
+        spans = defaultdict(lambda: [0, 0.0, 0.0])
+        counters = {}
+        for field, value in values.items():
+            kind, name = field.decode().split(':', 1)
+            if kind == 'counter':
+                counters[name] = float(value)
+            elif kind == 'span_count':
+                spans[name][0] = int(value)
+            elif kind == 'span_sum':
+                spans[name][1] = float(value)
+        for name, maximum in maximums:
+            spans[name.decode()][2] = maximum
+        return dict(spans), counters
+
+
+class LogExporter:
+    """
+    Структурированные записи в лог app.metrics (уровень DEBUG) для
+    отладки, по умолчанию отключён: запись на каждое значение.
+    """
+
+    def record_span(self, name, seconds):
+        logger.debug(
+            'span %s %.6f', name, seconds,
+            extra={'metric': name, 'seconds': seconds}
+        )
+
+    def record_counter(self, name, value):
+        logger.debug(
+            'counter %s %g', name, value,
+            extra={'metric': name, 'value': value}
+        )
+
+
+def get_exporters():
+    global _exporters
+    if _exporters is None:
+        with _exporters_lock:
+            if _exporters is None:
+                _exporters = [
+                    import_string(path)()
+                    for path in settings.METRICS_EXPORTERS
+                ]
+                # команды управления не шлют сигналов конца запроса
+                atexit.register(flush)
+    return _exporters
+
+
+def flush(**kwargs):
+    """
+    Отправляет накопленные метрики экспортёров (обработчик сигналов
+    конца запроса и задачи celery).
+    """
+    for exporter in _exporters or ():
+        if hasattr(exporter, 'flush'):
+            exporter.flush()
+
+
+def get_exporter(exporter_class):
+    """Экземпляр экспортёра нужного класса или None, если он отключён."""
+    for exporter in get_exporters():
+        if isinstance(exporter, exporter_class):
+            return exporter
+
+
+def incr(name, value=1):
+    """Увеличивает счётчик name на value."""
+    if not value:
+        return
+    for exporter in get_exporters():
+        exporter.record_counter(name, value)
+    summary = _summary.get()
+    if summary is not None:
+        summary.add_counter(name, value)
+
+
+def record_span(name, seconds):
+    for exporter in get_exporters():
+        exporter.record_span(name, seconds)
+    summary = _summary.get()
+    if summary is not None:
+        summary.add_span(name, seconds)
+
+
+@contextmanager
+def span(name):
+    """Замер времени блока кода: with span('storage.save'): ..."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+@contextmanager
+def collect():
+    """Собирает метрики блока (и запущенных из него потоков) в сводку."""
+    summary = Summary()
+    token = _summary.set(summary)
+    try:
+        yield summary
+    finally:
+        _summary.reset(token)
+
+
+def in_context(func):
+    """
+    Функция для пула потоков, выполняемая в контексте вызывающего потока,
+    чтобы её метрики попали в сводку запроса.
+    Подходит и для executor.map: каждый вызов выполняется в своей копии
+    контекста, а сводка у копий общая.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # Context.run из нескольких потоков сразу вызывает RuntimeError
+        return context.copy().run(func, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,37 @@
+# Generated by Django 4.1 on 2026-10-18 14:43
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('app', '0002_alter_modelwithfilesarray_files_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilesImportJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.PositiveBigIntegerField(verbose_name='ID объекта')),
+                ('field_name', models.CharField(max_length=255, verbose_name='Поле')),
+                ('urls', django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), size=None, verbose_name='Ссылки')),
+                ('status', models.CharField(choices=[('pending', 'В очереди'), ('running', 'Выполняется'), ('done', 'Завершено'), ('failed', 'Ошибка')], default='pending', max_length=16, verbose_name='Статус')),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='Обработано ссылок')),
+                ('files', django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), blank=True, default=list, size=None, verbose_name='Загруженные файлы')),
+                ('errors', django.contrib.postgres.fields.ArrayField(base_field=models.TextField(), blank=True, default=list, size=None, verbose_name='Ошибки')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создано')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype', verbose_name='Тип объекта')),
+            ],
+            options={
+                'verbose_name': 'Задание импорта файлов',
+                'verbose_name_plural': 'Задания импорта файлов',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
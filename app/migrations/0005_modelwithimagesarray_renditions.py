@@ -0,0 +1,18 @@
+# Generated by Django 4.1 on 2026-10-18 14:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_storedfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='modelwithimagesarray',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Производные изображения'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.1 on 2026-10-18 14:52
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_modelwithimagesarray_renditions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('file_name', models.CharField(max_length=255, verbose_name='Имя файла')),
+                ('content_type', models.CharField(blank=True, max_length=255, verbose_name='Тип содержимого')),
+                ('size', models.PositiveBigIntegerField(verbose_name='Размер')),
+                ('chunk_size', models.PositiveIntegerField(verbose_name='Размер части')),
+                ('received_chunks', django.contrib.postgres.fields.ArrayField(base_field=models.PositiveIntegerField(), blank=True, default=list, size=None, verbose_name='Полученные части')),
+                ('completed', models.BooleanField(default=False, verbose_name='Завершена')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создана')),
+            ],
+            options={
+                'verbose_name': 'Сессия загрузки файла',
+                'verbose_name_plural': 'Сессии загрузки файлов',
+            },
+        ),
+    ]
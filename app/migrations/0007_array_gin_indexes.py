@@ -0,0 +1,25 @@
+# Generated by Django 4.1 on 2026-10-18 16:10
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # индексы строятся без блокировки записи в таблицы
+    atomic = False
+
+    dependencies = [
+        ('app', '0006_uploadsession'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='modelwithfilesarray',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['files'], name='app_files_gin'),
+        ),
+        AddIndexConcurrently(
+            model_name='modelwithimagesarray',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['images'], name='app_images_gin'),
+        ),
+    ]
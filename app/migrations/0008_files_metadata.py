@@ -0,0 +1,23 @@
+# Generated by Django 4.1 on 2026-10-18 15:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_array_gin_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='modelwithfilesarray',
+            name='files_metadata',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Метаданные файлов'),
+        ),
+        migrations.AddField(
+            model_name='modelwithimagesarray',
+            name='files_metadata',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Метаданные файлов'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.1 on 2026-10-18 15:12
+
+import app.array_files
+import app.utils
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_files_metadata'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='modelwithfilesarray',
+            name='files',
+            field=app.array_files.FilesArrayModelField(base_field=models.FileField(upload_to=app.utils.upload_files_path), blank=True, default=list, null=True, size=None, verbose_name='Файлы'),
+        ),
+        migrations.AlterField(
+            model_name='modelwithimagesarray',
+            name='images',
+            field=app.array_files.FilesArrayModelField(base_field=models.ImageField(upload_to=app.utils.upload_files_path), blank=True, default=list, null=True, size=None, verbose_name='Изображения'),
+        ),
+    ]
@@ -1,42 +1,375 @@
+import math
+import os
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres.fields import ArrayField
-from django.core.files.storage import default_storage
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.db import connection, models
 from django.dispatch import receiver
 
+from app.array_files import FilesArrayModelField, prefetch_array_files
 from app.utils import upload_files_path
 
 
-class ModelWithImagesArray(models.Model):
-    images = ArrayField(
+class FilesArrayQuerySet(models.QuerySet):
+    """
+    Поиск объектов по путям файлов в массивах.
+    Запросы используют операторы @> и && и GIN-индексы массивов.
+    """
+    _prefetch_files = None
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._prefetch_files = self._prefetch_files
+        return clone
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super()._fetch_all()
+        if (
+            fetched and self._prefetch_files is not None
+            and issubclass(self._iterable_class, models.query.ModelIterable)
+        ):
+            field_names, sizes = self._prefetch_files
+            prefetch_array_files(
+                self._result_cache, field_names or None, sizes=sizes
+            )
+
+    def prefetch_files(self, *field_names, sizes=False):
+        """
+        Как prefetch_related: после выборки URL файлов массивов
+        получаются одним обращением к кэшу (см. prefetch_array_files).
+        """
+        clone = self._chain()
+        clone._prefetch_files = (field_names, sizes)
+        return clone
+
+    def get_array_fields(self, field_names=None):
+        if field_names:
+            return list(field_names)
+        return [
+            field.name for field in self.model._meta.get_fields()
+            if isinstance(field, ArrayField)
+            and isinstance(field.base_field, models.FileField)
+        ]
+
+    def containing(self, path, field_names=None):
+        """Объекты, в массивах которых есть файл path."""
+        query = models.Q()
+        for field_name in self.get_array_fields(field_names):
+            query |= models.Q(**{f'{field_name}__contains': [path]})
+        return self.filter(query)
+
+    def referencing(self, paths, field_names=None):
+        """Объекты, в массивах которых есть хотя бы один из путей."""
+        paths = list(paths)
+        if not paths:
+            return self.none()
+        query = models.Q()
+        for field_name in self.get_array_fields(field_names):
+            query |= models.Q(**{f'{field_name}__overlap': paths})
+        return self.filter(query)
+
+    def usages(self, paths, field_names=None):
+        """Словарь {путь: [pk объектов, где он используется]}."""
+        paths = set(paths)
+        field_names = self.get_array_fields(field_names)
+        usages = {path: [] for path in paths}
+        rows = self.referencing(paths, field_names).values_list(
+            'pk', *field_names
+        )
+        for pk, *arrays in rows:
+            found = paths.intersection(
+                path for array in arrays for path in array or []
+            )
+            for path in found:
+                usages[path].append(pk)
+        return usages
+
+
+class FilesMetadataMixin:
+    """Доступ к метаданным файлов массивов (поле files_metadata)."""
+
+    def get_file_metadata(self, path):
+        return (self.files_metadata or {}).get(path, {})
+
+    def files_with_metadata(self, field_name):
+        """Пары (путь, метаданные) для файлов массива field_name."""
+        return [
+            (path, self.get_file_metadata(path))
+            for path in getattr(self, field_name) or []
+        ]
+
+
+class ModelWithImagesArray(FilesMetadataMixin, models.Model):
+    images = FilesArrayModelField(
         models.ImageField(upload_to=upload_files_path),
         null=True, blank=True, default=list,
         verbose_name='Изображения'
     )
+    renditions = models.JSONField(
+        default=dict, blank=True, editable=False,
+        verbose_name='Производные изображения'
+    )
+    files_metadata = models.JSONField(
+        default=dict, blank=True, editable=False,
+        verbose_name='Метаданные файлов'
+    )
+
+    objects = FilesArrayQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Объект с массивом изображений'
         verbose_name_plural = 'Объекты с массивами изображений'
+        indexes = [GinIndex(fields=['images'], name='app_images_gin')]
 
 
-class ModelWithFilesArray(models.Model):
-    files = ArrayField(
+class ModelWithFilesArray(FilesMetadataMixin, models.Model):
+    files = FilesArrayModelField(
         models.FileField(upload_to=upload_files_path),
         null=True, blank=True, default=list,
         verbose_name='Файлы'
     )
+    files_metadata = models.JSONField(
+        default=dict, blank=True, editable=False,
+        verbose_name='Метаданные файлов'
+    )
+
+    objects = FilesArrayQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'Объект с массивом файлов'
         verbose_name_plural = 'Объекты с массивами файлов'
+        indexes = [GinIndex(fields=['files'], name='app_files_gin')]
+
+
+class FilesImportJob(models.Model):
+    """Фоновое задание на загрузку файлов по ссылкам в массив объекта."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (PENDING, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Завершено'),
+        (FAILED, 'Ошибка'),
+    )
+
+    content_type = models.ForeignKey(
+        ContentType, on_delete=models.CASCADE, verbose_name='Тип объекта'
+    )
+    object_id = models.PositiveBigIntegerField(verbose_name='ID объекта')
+    instance = GenericForeignKey('content_type', 'object_id')
+    field_name = models.CharField(max_length=255, verbose_name='Поле')
+    urls = ArrayField(models.TextField(), verbose_name='Ссылки')
+    status = models.CharField(
+        max_length=16, choices=STATUSES, default=PENDING,
+        verbose_name='Статус'
+    )
+    processed = models.PositiveIntegerField(
+        default=0, verbose_name='Обработано ссылок'
+    )
+    files = ArrayField(
+        models.TextField(), default=list, blank=True,
+        verbose_name='Загруженные файлы'
+    )
+    errors = ArrayField(
+        models.TextField(), default=list, blank=True, verbose_name='Ошибки'
+    )
+    created_at = models.DateTimeField(
+        auto_now_add=True, verbose_name='Создано'
+    )
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлено')
+
+    class Meta:
+        verbose_name = 'Задание импорта файлов'
+        verbose_name_plural = 'Задания импорта файлов'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f'{self.content_type} #{self.object_id}: {self.field_name}'
+
+
+class StoredFileManager(models.Manager):
+
+    def add_references(self, names):
+        """
+        Увеличивает счётчики ссылок на файлы, создавая записи при нужде.
+        Возвращает файлы, на которые до этого не было ссылок: их нужно
+        загрузить в хранилище (файл с нулевым счётчиком мог быть уже
+        удалён задачей удаления).
+        """
+        counts = Counter(names)
+        if not counts:
+            return set()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                INSERT INTO {self.model._meta.db_table} (name, ref_count)
+                SELECT * FROM unnest(%s::varchar[], %s::integer[])
+                ON CONFLICT (name) DO UPDATE
+                SET ref_count = {self.model._meta.db_table}.ref_count
+                    + EXCLUDED.ref_count
+                RETURNING name, ref_count
+                ''',
+                [list(counts), list(counts.values())]
+            )
+            return {
+                name for name, ref_count in cursor.fetchall()
+                if ref_count == counts[name]
+            }
+
+    def release(self, names):
+        """
+        Уменьшает счётчики ссылок на файлы.
+        Возвращает файлы, которые можно удалить из хранилища:
+        те, на которые больше нет ссылок, и те, что не учитываются.
+        Записи с нулевым счётчиком остаются до задачи удаления
+        (lock_released), иначе повторная загрузка того же файла
+        до её выполнения не увидела бы, что файл будет удалён.
+        """
+        if not settings.FILES_DEDUPLICATE:
+            return list(names)
+        counts = Counter(name for name in names if name)
+        if not counts:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'''
+                UPDATE {self.model._meta.db_table} AS s
+                SET ref_count = GREATEST(s.ref_count - v.n, 0)
+                FROM unnest(%s::varchar[], %s::integer[]) AS v(name, n)
+                WHERE s.name = v.name
+                RETURNING s.name, s.ref_count
+                ''',
+                [list(counts), list(counts.values())]
+            )
+            tracked = dict(cursor.fetchall())
+        return [name for name in counts if not tracked.get(name)]
+
+    def lock_released(self, names):
+        """
+        Блокирует записи файлов до конца транзакции и удаляет те,
+        на которые по-прежнему нет ссылок. Возвращает файлы, которые
+        можно удалить из хранилища; файлы, на которые снова сослались
+        после release, пропускаются. Новая ссылка на заблокированный
+        файл (add_references) ждёт конца транзакции и затем загружает
+        файл заново.
+        """
+        names = set(names)
+        ref_counts = dict(
+            self.select_for_update().filter(
+                name__in=names
+            ).values_list('name', 'ref_count')
+        )
+        released = {
+            name for name, ref_count in ref_counts.items() if not ref_count
+        }
+        self.filter(name__in=released).delete()
+        return {name for name in names if name not in ref_counts} | released
+
+
+class StoredFile(models.Model):
+    """
+    Файл в хранилище при дедупликации по содержимому (FILES_DEDUPLICATE).
+    Одинаковые файлы хранятся один раз, ref_count - число ссылок
+    на файл из массивов. Запись с нулевым счётчиком удаляется вместе
+    с файлом задачей удаления, если на файл снова не сослались.
+    """
+    name = models.CharField(
+        max_length=255, unique=True, verbose_name='Путь в хранилище'
+    )
+    ref_count = models.PositiveIntegerField(
+        default=0, verbose_name='Число ссылок'
+    )
+
+    objects = StoredFileManager()
+
+    class Meta:
+        verbose_name = 'Файл в хранилище'
+        verbose_name_plural = 'Файлы в хранилище'
+
+    def __str__(self):
+        return self.name
+
+
+class UploadSessionManager(models.Manager):
+
+    def discard(self, ids):
+        """Удаляет сессии загрузки вместе с их временными файлами."""
+        for session in self.filter(pk__in=ids):
+            session.delete()
+
+
+class UploadSession(models.Model):
+    """
+    Сессия загрузки файла частями (см. app/views.py).
+    Части пишутся по своим смещениям во временный файл на диске,
+    поэтому могут приходить параллельно и в любом порядке,
+    а прерванную загрузку можно продолжить с недостающих частей.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    file_name = models.CharField(max_length=255, verbose_name='Имя файла')
+    content_type = models.CharField(
+        max_length=255, blank=True, verbose_name='Тип содержимого'
+    )
+    size = models.PositiveBigIntegerField(verbose_name='Размер')
+    chunk_size = models.PositiveIntegerField(verbose_name='Размер части')
+    received_chunks = ArrayField(
+        models.PositiveIntegerField(), default=list, blank=True,
+        verbose_name='Полученные части'
+    )
+    completed = models.BooleanField(default=False, verbose_name='Завершена')
+    created_at = models.DateTimeField(
+        auto_now_add=True, verbose_name='Создана'
+    )
+
+    objects = UploadSessionManager()
+
+    class Meta:
+        verbose_name = 'Сессия загрузки файла'
+        verbose_name_plural = 'Сессии загрузки файлов'
+
+    def __str__(self):
+        return self.file_name
+
+    @property
+    def chunks_count(self):
+        return math.ceil(self.size / self.chunk_size)
+
+    @property
+    def path(self):
+        return os.path.join(settings.CHUNKED_UPLOAD_DIR, str(self.id))
+
+    @property
+    def missing_chunks(self):
+        return sorted(set(range(self.chunks_count)) - set(self.received_chunks))
+
+    def delete(self, *args, **kwargs):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+        return super().delete(*args, **kwargs)
 
 
 @receiver(models.signals.pre_delete, sender=ModelWithImagesArray)
 def delete_images(sender, instance, **kwargs):
-    for image in instance.images:
-        default_storage.delete(image)
+    from app.tasks import schedule_files_deletion
+
+    schedule_files_deletion(
+        StoredFile.objects.release(instance.images or []),
+        with_renditions=True
+    )
 
 
 @receiver(models.signals.pre_delete, sender=ModelWithFilesArray)
 def delete_files(sender, instance, **kwargs):
-    for file in instance.files:
-        default_storage.delete(file)
+    from app.tasks import schedule_files_deletion
+
+    schedule_files_deletion(StoredFile.objects.release(instance.files or []))
@@ -0,0 +1,106 @@
+"""
+Стратегии именования файлов в хранилище.
+Стратегия - функция (file_name, file), возвращающая итоговый путь файла.
+Используемая стратегия задаётся настройкой FILES_NAMING_STRATEGY:
+ключом из NAMING_STRATEGIES или путём к своей функции.
+"""
+import hashlib
+import os
+import random
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from slugify import slugify
+
+from app import metrics
+from app.utils import is_cyrillic
+
+MAX_NAME_LENGTH = 40
+
+
+def split_file_name(file_name):
+    """Разбивает путь на каталог, имя (латиницей) и расширение."""
+    full_path, extension = os.path.splitext(file_name)
+    split_path = full_path.split('/')
+    name = split_path[-1]
+    path = '/'.join(split_path[:-1]) + '/'
+    if is_cyrillic(name):
+        name = slugify(name)
+    return path, name, extension
+
+
+def check_file_name(file_name, file=None):
+    """
+    Режим совместимости: имя файла сохраняется,
+    а при дубликате добавляется случайный суффикс.
+    Проверяет наличие файла в хранилище, поэтому на сторонних
+    хранилищах каждая попытка - это сетевой запрос.
+    """
+    path, name, extension = split_file_name(file_name)
+    file_name = f'{path}{name}{extension}'
+    while default_storage.exists(file_name):
+        metrics.incr('name_collisions')
+        suffix = ''.join(random.choices(settings.SYMBOLS, k=5))
+        file_name = f'{path}{name}_{suffix}{extension}'
+    return file_name
+
+
+def uuid_file_name(file_name, file=None):
+    """Исходное имя с уникальным суффиксом uuid4, без обращений к хранилищу."""
+    path, name, extension = split_file_name(file_name)
+    return f'{path}{name[:MAX_NAME_LENGTH]}_{uuid.uuid4().hex}{extension}'
+
+
+def date_file_name(file_name, file=None):
+    """Как uuid, но с разбивкой по каталогам даты загрузки (ГГГГ/ММ/ДД)."""
+    path, name, extension = split_file_name(file_name)
+    date_path = timezone.now().strftime('%Y/%m/%d')
+    return (
+        f'{path}{date_path}/{name[:MAX_NAME_LENGTH]}_{uuid.uuid4().hex[:12]}'
+        f'{extension}'
+    )
+
+
+def file_hash(file):
+    """
+    sha256 содержимого файла, читаемого по частям.
+    Если хэш уже посчитан при загрузке, файл не перечитывается.
+    """
+    if getattr(file, 'sha256', None):
+        return file.sha256
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def hash_file_name(file_name, file):
+    """Имя по хэшу содержимого: одинаковые файлы получают одинаковый путь."""
+    path, _, extension = split_file_name(file_name)
+    return f'{path}{file_hash(file)}{extension.lower()}'
+
+
+NAMING_STRATEGIES = {
+    'compat': check_file_name,
+    'uuid': uuid_file_name,
+    'date': date_file_name,
+    'hash': hash_file_name,
+}
+
+
+def get_naming_strategy(strategy=None):
+    strategy = strategy or settings.FILES_NAMING_STRATEGY
+    if callable(strategy):
+        return strategy
+    if strategy in NAMING_STRATEGIES:
+        return NAMING_STRATEGIES[strategy]
+    return import_string(strategy)
+
+
+def get_file_name(file_name, file=None, strategy=None):
+    """Итоговый путь файла по выбранной стратегии именования."""
+    return get_naming_strategy(strategy)(file_name, file)
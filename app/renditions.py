@@ -0,0 +1,150 @@
+"""
+Производные изображения (миниатюры и т.п.) для массивов изображений.
+Набор производных задаётся настройкой IMAGE_RENDITIONS:
+{имя: {'size': (ширина, высота), 'format': 'WEBP', 'quality': 80}}.
+Производные создаются задачами celery и хранятся рядом с оригиналом,
+а их пути записываются в поле renditions модели:
+{путь оригинала: {имя производной: путь}}.
+"""
+import io
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import models
+from PIL import Image
+
+from app.utils import jsonb_edit_expression
+
+RENDITIONS_FIELD = 'renditions'
+
+
+def has_renditions(model, field_name):
+    """Нужны ли производные для массива field_name модели."""
+    field = model._meta.get_field(field_name)
+    return bool(
+        settings.IMAGE_RENDITIONS
+        and isinstance(field.base_field, models.ImageField)
+        and any(f.name == RENDITIONS_FIELD for f in model._meta.fields)
+    )
+
+
+def get_rendition_name(path, name):
+    """Путь производной: каталог оригинала/renditions/имя/файл.формат."""
+    directory, file_name = os.path.split(path)
+    extension = settings.IMAGE_RENDITIONS[name]['format'].lower()
+    return f'{directory}/renditions/{name}/{file_name}.{extension}'
+
+
+def get_rendition_names(path):
+    """Пути всех производных оригинала (для удаления вместе с ним)."""
+    return [
+        get_rendition_name(path, name) for name in settings.IMAGE_RENDITIONS
+    ]
+
+
+def create_renditions(path):
+    """
+    Создаёт все производные изображения, которых ещё нет в хранилище.
+    Пути производных детерминированы, поэтому повторный запуск безопасен.
+    """
+    renditions = {}
+    with default_storage.open(path) as file, Image.open(file) as image:
+        for name, options in settings.IMAGE_RENDITIONS.items():
+            rendition_name = get_rendition_name(path, name)
+            if not default_storage.exists(rendition_name):
+                default_storage.save(
+                    rendition_name, render(image, options)
+                )
+            renditions[name] = rendition_name
+    return renditions
+
+
+def render(image, options):
+    rendition = image.copy()
+    rendition.thumbnail(options['size'])
+    image_format = options['format'].upper()
+    if image_format == 'JPEG' and rendition.mode not in ('RGB', 'L'):
+        rendition = rendition.convert('RGB')
+    elif rendition.mode not in ('RGB', 'RGBA', 'L'):
+        rendition = rendition.convert('RGBA')
+    buffer = io.BytesIO()
+    rendition.save(
+        buffer, image_format, quality=options.get('quality', 85)
+    )
+    return ContentFile(buffer.getvalue())
+
+
+def merge_renditions(model, pk, renditions):
+    """Атомарно дописывает пути производных в поле renditions (jsonb ||)."""
+    return model.objects.filter(pk=pk).update(**{
+        RENDITIONS_FIELD: jsonb_edit_expression(
+            RENDITIONS_FIELD, merged=renditions
+        )
+    })
+
+
+def drop_renditions_expression(paths):
+    """Выражение, убирающее из поля renditions ключи оригиналов (jsonb -)."""
+    return jsonb_edit_expression(RENDITIONS_FIELD, removed=paths)
+
+
+def schedule_renditions(instance, paths):
+    """Ставит в очередь создание производных для изображений объекта."""
+    queue_renditions([(instance, path) for path in paths])
+
+
+def queue_renditions(items):
+    """
+    Ставит в очередь создание производных для пар (объект, путь)
+    одной модели группой задач по RENDITIONS_CHUNK_SIZE файлов, чтобы
+    их обрабатывали параллельно несколько воркеров. Пути, задача для
+    которых ещё не выполнилась, пропускаются; кэш проверяется одним
+    get_many.
+    """
+    from celery import group
+
+    from app.tasks import make_renditions
+
+    if not items:
+        return
+    label = items[0][0]._meta.label
+    keys = {
+        rendition_task_key(label, path): (instance, path)
+        for instance, path in items
+    }
+    queued = cache.get_many(keys)
+    pending = [
+        (instance.pk, path)
+        for key, (instance, path) in keys.items() if key not in queued
+    ]
+    if not pending:
+        return
+    cache.set_many(
+        {rendition_task_key(label, path): True for _, path in pending},
+        timeout=300
+    )
+    chunk_size = settings.RENDITIONS_CHUNK_SIZE
+    group(
+        make_renditions.s(label, pending[start:start + chunk_size])
+        for start in range(0, len(pending), chunk_size)
+    ).apply_async()
+
+
+def rendition_task_key(model_label, path):
+    return f'renditions:{model_label}:{path}'
+
+
+def get_rendition(instance, path, name, renditions=None):
+    """
+    Путь производной изображения или None, если она ещё не готова.
+    Недостающие производные ставит в очередь вызывающий код
+    (queue_renditions), группой задач для всех файлов.
+    renditions - словарь производных вместо поля объекта
+    (например, только для части файлов в списке админки).
+    """
+    if renditions is None:
+        renditions = getattr(instance, RENDITIONS_FIELD, {})
+    return renditions.get(path, {}).get(name)
@@ -0,0 +1,135 @@
+/*
+ * Загрузка файлов частями для виджета ChunkedFilesInput.
+ * Части каждого файла отправляются параллельно, при обрыве связи
+ * загрузка продолжается с недостающих частей. В форму попадают
+ * только id завершённых сессий загрузки.
+ */
+(function () {
+    'use strict';
+
+    const MAX_ATTEMPTS = 5;
+
+    function getCookie(name) {
+        const cookie = document.cookie.split('; ').find(
+            (item) => item.startsWith(name + '=')
+        );
+        return cookie ? decodeURIComponent(cookie.split('=')[1]) : '';
+    }
+
+    function sleep(ms) {
+        return new Promise((resolve) => setTimeout(resolve, ms));
+    }
+
+    async function request(method, url, body, headers) {
+        const response = await fetch(url, {
+            method: method,
+            body: body,
+            credentials: 'same-origin',
+            headers: Object.assign(
+                {'X-CSRFToken': getCookie('csrftoken')}, headers || {}
+            )
+        });
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || response.statusText);
+        }
+        return data;
+    }
+
+    async function getSession(baseUrl, file) {
+        const storageKey = [
+            'chunked-upload', baseUrl, file.name, file.size, file.lastModified
+        ].join(':');
+        const savedId = localStorage.getItem(storageKey);
+        if (savedId) {
+            try {
+                const session = await request('GET', baseUrl + savedId + '/');
+                if (!session.completed) {
+                    return {session: session, storageKey: storageKey};
+                }
+            } catch (error) {
+                localStorage.removeItem(storageKey);
+            }
+        }
+        const session = await request('POST', baseUrl, JSON.stringify({
+            name: file.name, size: file.size, content_type: file.type
+        }), {'Content-Type': 'application/json'});
+        localStorage.setItem(storageKey, session.id);
+        return {session: session, storageKey: storageKey};
+    }
+
+    async function uploadChunk(url, blob) {
+        for (let attempt = 1; ; attempt++) {
+            try {
+                return await request('PUT', url, blob, {
+                    'Content-Type': 'application/octet-stream'
+                });
+            } catch (error) {
+                if (attempt >= MAX_ATTEMPTS) {
+                    throw error;
+                }
+                await sleep(500 * 2 ** attempt);
+            }
+        }
+    }
+
+    async function uploadFile(input, file, onProgress) {
+        const baseUrl = input.dataset.uploadUrl;
+        const {session, storageKey} = await getSession(baseUrl, file);
+        const sessionUrl = baseUrl + session.id + '/';
+        const received = new Set(session.received_chunks);
+        const queue = [];
+        for (let index = 0; index < session.chunks_count; index++) {
+            if (!received.has(index)) {
+                queue.push(index);
+            }
+        }
+        let done = received.size;
+        onProgress(done, session.chunks_count);
+        const parallel = parseInt(input.dataset.parallel, 10) || 1;
+        await Promise.all(Array.from({length: parallel}, async () => {
+            while (queue.length) {
+                const index = queue.shift();
+                const start = index * session.chunk_size;
+                await uploadChunk(
+                    sessionUrl + index + '/',
+                    file.slice(start, start + session.chunk_size)
+                );
+                onProgress(++done, session.chunks_count);
+            }
+        }));
+        await request('POST', sessionUrl + 'complete/');
+        localStorage.removeItem(storageKey);
+        return session.id;
+    }
+
+    document.addEventListener('change', async function (event) {
+        const input = event.target;
+        if (!input.matches('input[type=file][data-chunked-upload]')) {
+            return;
+        }
+        const keys = document.getElementById(input.id + '_keys');
+        const status = input.parentNode.querySelector('.chunked-upload-status');
+        const submits = input.form.querySelectorAll('[type=submit]');
+        const files = Array.from(input.files);
+        const ids = [];
+        submits.forEach((button) => { button.disabled = true; });
+        try {
+            for (const file of files) {
+                ids.push(await uploadFile(input, file, (done, total) => {
+                    status.textContent = file.name + ': ' +
+                        Math.round(done / total * 100) + '% (' +
+                        (ids.length + 1) + '/' + files.length + ')';
+                }));
+            }
+            keys.value = ids.join('\n');
+            status.textContent = 'Загружено файлов: ' + ids.length;
+        } catch (error) {
+            keys.value = '';
+            status.textContent = 'Ошибка загрузки: ' + error.message +
+                '. Выберите файлы снова, чтобы продолжить.';
+        } finally {
+            submits.forEach((button) => { button.disabled = false; });
+        }
+    });
+})();
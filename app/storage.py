@@ -0,0 +1,194 @@
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from app import metrics
+from app.models import StoredFile
+from app.naming import get_file_name, hash_file_name
+
+# максимум ключей в одном запросе DeleteObjects к S3
+S3_DELETE_BATCH_SIZE = 1000
+
+
+def get_upload_name(instance, field_name, file_name):
+    """Путь файла с учётом upload_to вложенного в массив файлового поля."""
+    upload_to = instance._meta.get_field(field_name).base_field.upload_to
+    if callable(upload_to):
+        return upload_to(instance, file_name)
+    return upload_to + file_name
+
+
+def save_file(instance, field_name, file, naming=get_file_name):
+    """Сохраняет файл в хранилище и возвращает его итоговый путь."""
+    file_name = naming(get_upload_name(instance, field_name, file.name), file)
+    with metrics.span('storage.save'):
+        name = default_storage.save(file_name, file)
+    metrics.incr('stored_files')
+    metrics.incr('stored_bytes', file.size or 0)
+    return name
+
+
+def delete_files(files):
+    """
+    Удаляет файлы из хранилища. Если хранилище умеет удалять пачкой
+    (метод delete_many или bucket S3 из django-storages), файлы удаляются
+    пачками, иначе - параллельно, не более STORAGE_MAX_WORKERS потоков.
+    """
+    if not files:
+        return
+    metrics.incr('deleted_files', len(files))
+    with metrics.span('storage.delete'):
+        _delete_files(files)
+
+
+def _delete_files(files):
+    if hasattr(default_storage, 'delete_many'):
+        default_storage.delete_many(files)
+        return
+    bucket = getattr(default_storage, 'bucket', None)
+    if bucket is not None and hasattr(default_storage, '_normalize_name'):
+        for start in range(0, len(files), S3_DELETE_BATCH_SIZE):
+            bucket.delete_objects(Delete={
+                'Objects': [
+                    {'Key': default_storage._normalize_name(file)}
+                    for file in files[start:start + S3_DELETE_BATCH_SIZE]
+                ],
+                'Quiet': True
+            })
+        return
+    with ThreadPoolExecutor(
+        max_workers=min(settings.STORAGE_MAX_WORKERS, len(files))
+    ) as executor:
+        list(executor.map(
+            metrics.in_context(default_storage.delete), files
+        ))
+
+
+def save_files(instance, field_name, files, strategy=None):
+    """Сохраняет файлы одного массива, см. save_arrays."""
+    return save_arrays(instance, {field_name: files}, strategy)[field_name]
+
+
+def save_arrays(instance, arrays, strategy=None):
+    """
+    Параллельно (не более STORAGE_MAX_WORKERS потоков) сохраняет
+    в хранилище файлы нескольких массивов объекта одной пачкой.
+    arrays - {имя поля: файлы}, возвращает {имя поля: пути}
+    с путями в исходном порядке.
+    Имена генерируются стратегией strategy (по умолчанию из настроек).
+    Если хотя бы один файл сохранить не удалось, уже сохранённые
+    файлы удаляются, а исключение пробрасывается дальше.
+    """
+    items = [
+        (field_name, file)
+        for field_name, files in arrays.items() for file in files
+    ]
+    saved = {field_name: [] for field_name in arrays}
+    if not items:
+        return saved
+    with metrics.span('storage.save_batch'):
+        if settings.FILES_DEDUPLICATE:
+            names = save_files_deduplicated(instance, items)
+        else:
+            names = _save_items(instance, items, strategy)
+    for (field_name, _), name in zip(items, names):
+        saved[field_name].append(name)
+    return saved
+
+
+def _save_items(instance, items, strategy):
+    reserved = set()
+    lock = threading.Lock()
+
+    def reserve_name(file_name, file):
+        # имена генерируются параллельно, поэтому одинаковые имена
+        # внутри одной пачки нужно развести до записи в хранилище
+        file_name = get_file_name(file_name, file, strategy)
+        full_path, extension = os.path.splitext(file_name)
+        with lock:
+            while file_name in reserved:
+                metrics.incr('name_collisions')
+                suffix = ''.join(random.choices(settings.SYMBOLS, k=5))
+                file_name = f'{full_path}_{suffix}{extension}'
+            reserved.add(file_name)
+        return file_name
+
+    with ThreadPoolExecutor(
+        max_workers=min(settings.STORAGE_MAX_WORKERS, len(items))
+    ) as executor:
+        futures = [
+            executor.submit(
+                metrics.in_context(save_file),
+                instance, field_name, file, reserve_name
+            )
+            for field_name, file in items
+        ]
+    errors = [future.exception() for future in futures if future.exception()]
+    if errors:
+        delete_files([
+            future.result() for future in futures if not future.exception()
+        ])
+        raise errors[0]
+    return [future.result() for future in futures]
+
+
+def save_files_deduplicated(instance, items):
+    """
+    Сохранение с дедупликацией по содержимому: путь файла строится
+    по sha256, в хранилище загружаются только файлы, которых там ещё нет,
+    а для остальных лишь увеличивается счётчик ссылок в StoredFile.
+    items - пары (имя поля, файл).
+    """
+    with ThreadPoolExecutor(
+        max_workers=min(settings.STORAGE_MAX_WORKERS, len(items))
+    ) as executor:
+        names = list(executor.map(
+            lambda item: hash_file_name(
+                get_upload_name(instance, item[0], item[1].name), item[1]
+            ),
+            items
+        ))
+    files = [file for _, file in items]
+    # ссылки добавляются до загрузки: запись блокируется до конца
+    # транзакции, и задача удаления не удалит файл посреди загрузки
+    missing = StoredFile.objects.add_references(names)
+    new_files = {}
+    for name, file in zip(names, files):
+        if name in missing:
+            new_files.setdefault(name, file)
+    if new_files:
+        with ThreadPoolExecutor(
+            max_workers=min(settings.STORAGE_MAX_WORKERS, len(new_files))
+        ) as executor:
+            futures = [
+                executor.submit(
+                    metrics.in_context(default_storage.save), name, file
+                )
+                for name, file in new_files.items()
+            ]
+        errors = [
+            future.exception() for future in futures if future.exception()
+        ]
+        saved = [
+            future.result() for future in futures if not future.exception()
+        ]
+        if errors:
+            from app.tasks import schedule_files_deletion
+            delete_files(saved)
+            schedule_files_deletion(StoredFile.objects.release(names))
+            raise errors[0]
+        # файл с нулевым счётчиком ещё мог быть в хранилище,
+        # тогда хранилище сохранит копию под другим именем
+        delete_files([
+            saved_name for saved_name in saved if saved_name not in new_files
+        ])
+    metrics.incr('stored_files', len(new_files))
+    metrics.incr('stored_bytes', sum(
+        file.size or 0 for file in new_files.values()
+    ))
+    metrics.incr('dedup_hits', len(names) - len(new_files))
+    return names
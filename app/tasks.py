@@ -1,9 +1,198 @@
-from django.core.files.storage import default_storage
+import threading
+from collections import defaultdict
+from datetime import timedelta
 
+from django.apps import apps
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.utils import timezone
+
+from app import metrics
+from app.fields import url_input_field_for
+from app.file_urls import FileURLResolver
+from app.metadata import collect_metadata, has_metadata, merge_metadata
+from app.models import FilesImportJob, StoredFile, UploadSession
+from app.renditions import (create_renditions, get_rendition_names,
+                            has_renditions, merge_renditions,
+                            schedule_renditions)
+from app.storage import delete_files, save_files
+from app.utils import append_to_array
 from django_admin_array_files_upload.celery import app
 
 
+_pending_deletion = threading.local()
+
+
+@app.task(
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    retry_kwargs={'max_retries': settings.FILES_DELETE_MAX_RETRIES}
+)
+def delete_old_files_from_storage(files, with_renditions=False, images=()):
+    """
+    Удаляет файлы из хранилища вместе с производными изображений:
+    всех файлов при with_renditions, иначе только файлов из images.
+    Задача идемпотентна: при ошибке она повторяется целиком.
+    Счётчики ссылок StoredFile к этому моменту уже уменьшены;
+    при дедупликации записи файлов блокируются до удаления из
+    хранилища, а файлы, на которые снова сослались, пропускаются.
+    """
+    if delete_old_files_from_storage.request.retries:
+        metrics.incr('delete_retries')
+    images = files if with_renditions else images
+    with transaction.atomic():
+        if settings.FILES_DEDUPLICATE:
+            released = StoredFile.objects.lock_released(files)
+            files = [file for file in files if file in released]
+            images = [file for file in images if file in released]
+        files = files + [
+            rendition for file in images
+            for rendition in get_rendition_names(file)
+        ]
+        delete_files(files)
+    FileURLResolver().forget(files)
+
+
+def schedule_files_deletion(files, with_renditions=False):
+    """
+    Откладывает удаление файлов из хранилища до фиксации транзакции.
+    Файлы, собранные за одну транзакцию (например, при массовом
+    удалении объектов), отправляются в celery общими пачками по
+    FILES_DELETE_CHUNK_SIZE, поэтому в запросе нет обращений к хранилищу.
+    """
+    files = [(file, with_renditions) for file in files if file]
+    if not files:
+        return
+    if not connection.in_atomic_block:
+        send_files_deletion(files)
+        return
+    # run_on_commit - новый список для каждой транзакции, а savepoint_ids
+    # отличает точки сохранения: при их откате Django отбрасывает
+    # зарегистрированный в них on_commit вместе с собранными файлами
+    savepoints = tuple(connection.savepoint_ids)
+    if getattr(_pending_deletion, 'transaction', None) is not (
+        connection.run_on_commit
+    ) or _pending_deletion.savepoints != savepoints:
+        pending = []
+        _pending_deletion.files = pending
+        transaction.on_commit(lambda: send_files_deletion(pending))
+        _pending_deletion.transaction = connection.run_on_commit
+        _pending_deletion.savepoints = savepoints
+    _pending_deletion.files.extend(files)
+
+
+def send_files_deletion(pending):
+    """pending - пары (файл, удалять ли производные)."""
+    chunk_size = settings.FILES_DELETE_CHUNK_SIZE
+    for start in range(0, len(pending), chunk_size):
+        chunk = pending[start:start + chunk_size]
+        delete_old_files_from_storage.apply_async([
+            [file for file, _ in chunk], False,
+            [file for file, with_renditions in chunk if with_renditions]
+        ])
+
+
+@app.task
+def collect_orphan_files():
+    """Периодическое удаление файлов, на которые нет ссылок."""
+    call_command('collect_orphan_files', delete=True)
+
+
+@app.task
+def delete_expired_upload_sessions():
+    """Удаляет незавершённые и неиспользованные сессии загрузки частями."""
+    UploadSession.objects.discard(UploadSession.objects.filter(
+        created_at__lt=timezone.now() - timedelta(
+            hours=settings.CHUNKED_UPLOAD_EXPIRE_HOURS
+        )
+    ).values_list('pk', flat=True))
+
+
+@app.task
+def make_renditions(model_label, items):
+    """
+    Создаёт производные изображений и записывает их пути в объекты.
+    items - пары (pk объекта, путь оригинала).
+    """
+    model = apps.get_model(model_label)
+    renditions = defaultdict(dict)
+    errors = []
+    for pk, path in items:
+        # битое или удалённое изображение не мешает остальным
+        try:
+            renditions[pk][path] = create_renditions(path)
+        except Exception as exc:
+            errors.append(exc)
+    for pk, paths in renditions.items():
+        merge_renditions(model, pk, paths)
+    if errors:
+        raise errors[0]
+
+
 @app.task
-def delete_old_files_from_storage(files):
-    for file in files:
-        default_storage.delete(file)
+def import_files_from_urls(job_id):
+    """
+    Скачивает, проверяет и сохраняет файлы задания импорта,
+    дописывая их в массив объекта по мере загрузки.
+    """
+    job = FilesImportJob.objects.select_related('content_type').get(
+        pk=job_id
+    )
+    model = job.content_type.model_class()
+    instance = model.objects.filter(pk=job.object_id).first()
+    if instance is None:
+        job.status = FilesImportJob.FAILED
+        job.errors.append('Объект удалён до начала импорта')
+        job.save(update_fields=['status', 'errors', 'updated_at'])
+        return
+    field = url_input_field_for(model._meta.get_field(job.field_name))
+    job.status = FilesImportJob.RUNNING
+    job.save(update_fields=['status', 'updated_at'])
+    batch_size = settings.URL_FETCH_MAX_WORKERS
+    with_renditions = has_renditions(model, job.field_name)
+    for start in range(0, len(job.urls), batch_size):
+        urls = job.urls[start:start + batch_size]
+        files_data = saved = []
+        appended = False
+        try:
+            with metrics.span('import.batch'):
+                files_data, errors = field.download_files(urls)
+                saved = save_files(instance, job.field_name, files_data)
+            if saved:
+                appended = append_to_array(
+                    model, job.object_id, job.field_name, saved
+                )
+                if not appended:
+                    job.status = FilesImportJob.FAILED
+                    job.errors.append('Объект удалён во время импорта')
+                    job.save(update_fields=['status', 'errors', 'updated_at'])
+                    return
+                if has_metadata(model):
+                    merge_metadata(
+                        model, job.object_id,
+                        collect_metadata(saved, files_data)
+                    )
+                if with_renditions:
+                    schedule_renditions(instance, saved)
+            job.processed += len(urls)
+            job.files.extend(saved)
+            job.errors.extend(' '.join(error.messages) for error in errors)
+            job.save(
+                update_fields=['processed', 'files', 'errors', 'updated_at']
+            )
+        except Exception as exc:
+            job.status = FilesImportJob.FAILED
+            job.errors.append(f'Ошибка импорта: {exc}')
+            job.save(update_fields=['status', 'errors', 'updated_at'])
+            raise
+        finally:
+            # сохранённые, но не попавшие в массив файлы не нужны
+            if saved and not appended:
+                schedule_files_deletion(
+                    StoredFile.objects.release(saved), with_renditions
+                )
+            for file in files_data:
+                file.close()
+    job.status = FilesImportJob.FAILED if job.errors else FilesImportJob.DONE
+    job.save(update_fields=['status', 'updated_at'])
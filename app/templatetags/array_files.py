@@ -0,0 +1,35 @@
+"""
+Теги для вывода файлов из массивов в шаблонах.
+URL берутся из кэша через общий для запроса резолвер:
+
+    {% load array_files %}
+    {% prefetch_file_urls object_list 'images' %}
+    {% for image in object.images %}{% file_url image %}{% endfor %}
+"""
+from django import template
+
+from app.file_urls import get_request_resolver, prefetch_file_urls
+
+register = template.Library()
+
+
+def _resolver(context):
+    return get_request_resolver(context.get('request'))
+
+
+@register.simple_tag(takes_context=True, name='prefetch_file_urls')
+def prefetch_file_urls_tag(context, objects, *field_names):
+    """Получает URL файлов всех объектов страницы одной пачкой."""
+    prefetch_file_urls(objects, field_names, _resolver(context))
+    return ''
+
+
+@register.simple_tag(takes_context=True)
+def file_url(context, path):
+    return _resolver(context).url(path) if path else ''
+
+
+@register.simple_tag(takes_context=True)
+def file_urls(context, paths):
+    """Список URL массива: {% file_urls object.files as urls %}."""
+    return _resolver(context).urls_for(paths or [])
@@ -0,0 +1,51 @@
+import io
+import shutil
+import tempfile
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from app.models import ModelWithFilesArray, StoredFile
+
+
+class CollectOrphanFilesTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings_override = override_settings(
+            MEDIA_ROOT=media_root, FILES_DEDUPLICATE=True
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def save(self, name):
+        return default_storage.save(name, ContentFile(b'data'))
+
+    def collect(self):
+        call_command(
+            'collect_orphan_files', delete=True, min_age=0, exact=True,
+            prefixes=['path/to/files'], stdout=io.StringIO()
+        )
+
+    def test_keeps_files_with_pending_references(self):
+        # сохранение уже добавило ссылку, но массив ещё не записан
+        pending = self.save('path/to/files/pending.txt')
+        StoredFile.objects.create(name=pending, ref_count=1)
+        self.collect()
+        self.assertTrue(default_storage.exists(pending))
+        self.assertTrue(StoredFile.objects.filter(name=pending).exists())
+
+    def test_deletes_released_and_untracked_orphans(self):
+        released = self.save('path/to/files/released.txt')
+        StoredFile.objects.create(name=released, ref_count=0)
+        untracked = self.save('path/to/files/untracked.txt')
+        used = self.save('path/to/files/used.txt')
+        ModelWithFilesArray.objects.create(files=[used])
+        self.collect()
+        self.assertFalse(default_storage.exists(released))
+        self.assertFalse(StoredFile.objects.filter(name=released).exists())
+        self.assertFalse(default_storage.exists(untracked))
+        self.assertTrue(default_storage.exists(used))
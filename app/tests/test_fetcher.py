@@ -0,0 +1,62 @@
+import threading
+from unittest import mock
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+
+from app import fetcher
+
+
+@override_settings(
+    URL_FETCH_BREAKER_THRESHOLD=1, URL_FETCH_BREAKER_COOLDOWN=0,
+    URL_FETCH_HOST_RATE=0, URL_FETCH_BLOCK_PRIVATE=True,
+    URL_FETCH_ALLOWED_HOSTS=[]
+)
+class CircuitBreakerTrialTests(SimpleTestCase):
+
+    def setUp(self):
+        fetcher._hosts.clear()
+        self.addCleanup(fetcher._hosts.clear)
+
+    def test_fetch_error_during_trial_settles_breaker(self):
+        state = fetcher.get_host_state('example.com')
+        state.breaker.failure()
+        # проверка адреса при соединении отклоняет пробный запрос
+        with mock.patch.object(
+            fetcher, 'resolve_public_addresses',
+            side_effect=fetcher.FetchError('адрес во внутренней сети')
+        ):
+            with self.assertRaises(fetcher.FetchError):
+                fetcher.get('http://example.com/a.png')
+        self.assertFalse(state.breaker.trial)
+        # после cooldown хост снова получает пробный запрос
+        self.assertTrue(state.breaker.allow())
+
+    def test_empty_address_list_raises_fetch_error(self):
+        connection = fetcher.CheckedHTTPConnection('example.com', 80)
+        with mock.patch.object(
+            fetcher, 'resolve_public_addresses', return_value=[]
+        ):
+            with self.assertRaises(fetcher.FetchError):
+                connection._new_conn()
+
+
+class FetchURLsTests(SimpleTestCase):
+
+    @override_settings(URL_FETCH_TOTAL_TIMEOUT=0.01)
+    def test_file_of_timed_out_download_is_closed(self):
+        release = threading.Event()
+        finished = threading.Event()
+        file = SimpleUploadedFile('a.txt', b'data')
+
+        def download(url):
+            release.wait(5)
+            return file
+
+        with mock.patch.object(fetcher, 'download', download):
+            results = fetcher.fetch_urls(['http://example.com/a.txt'])
+            self.assertIsNone(results[0].file)
+            self.assertTrue(results[0].error)
+            file.close = mock.Mock(side_effect=finished.set)
+            release.set()
+            self.assertTrue(finished.wait(5))
@@ -0,0 +1,62 @@
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+
+from app.management.commands import import_array_files
+from app.models import ModelWithFilesArray
+
+
+class ImportArrayFilesTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        settings_override = override_settings(
+            MEDIA_ROOT=os.path.join(self.directory, 'media')
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.instance = ModelWithFilesArray.objects.create()
+        self.manifest = os.path.join(self.directory, 'manifest.csv')
+        with open(self.manifest, 'w') as manifest:
+            manifest.write('row,source\n')
+            for name in ('a.txt', 'b.txt'):
+                with open(os.path.join(self.directory, name), 'w') as file:
+                    file.write(name)
+                manifest.write(f'{self.instance.pk},{name}\n')
+
+    def run_import(self):
+        call_command(
+            'import_array_files', self.manifest,
+            'app.ModelWithFilesArray.files', base_dir=self.directory,
+            processes=1, stdout=io.StringIO(), stderr=io.StringIO()
+        )
+
+    def test_imports_files_with_metadata(self):
+        self.run_import()
+        self.instance.refresh_from_db()
+        self.assertEqual(len(self.instance.files), 2)
+        self.assertEqual(
+            set(self.instance.files_metadata), set(self.instance.files)
+        )
+
+    def test_resume_after_crash_before_checkpoint_skips_batch(self):
+        write_checkpoint = import_array_files.Command.write_checkpoint
+
+        def crash_after_commit(command, done, pending=None):
+            if pending is None:
+                raise KeyboardInterrupt
+            write_checkpoint(command, done, pending)
+
+        with mock.patch.object(
+            import_array_files.Command, 'write_checkpoint', crash_after_commit
+        ), self.assertRaises(KeyboardInterrupt):
+            self.run_import()
+        self.run_import()
+        self.instance.refresh_from_db()
+        self.assertEqual(len(self.instance.files), 2)
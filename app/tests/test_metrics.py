@@ -0,0 +1,41 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from app import metrics
+
+
+@override_settings(METRICS_FLUSH_INTERVAL=60)
+class RedisPrometheusExporterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.exporter = metrics.RedisPrometheusExporter()
+        self.exporter.redis = mock.Mock()
+
+    def test_values_are_buffered_until_flush(self):
+        for seconds in (0.1, 0.3):
+            self.exporter.record_span('storage.save', seconds)
+            self.exporter.record_counter('stored_bytes', 10)
+        self.exporter.redis.pipeline.assert_not_called()
+        self.exporter.flush()
+        pipeline = self.exporter.redis.pipeline.return_value
+        self.exporter.redis.pipeline.assert_called_once()
+        pipeline.hincrby.assert_called_once_with(
+            self.exporter.key, 'span_count:storage.save', 2
+        )
+        pipeline.zadd.assert_called_once_with(
+            self.exporter.max_key, {'storage.save': 0.3}, gt=True
+        )
+        pipeline.hincrbyfloat.assert_any_call(
+            self.exporter.key, 'counter:stored_bytes', 20
+        )
+        pipeline.execute.assert_called_once()
+
+    def test_empty_flush_skips_redis(self):
+        self.exporter.flush()
+        self.exporter.redis.pipeline.assert_not_called()
+
+    @override_settings(METRICS_FLUSH_INTERVAL=0)
+    def test_flush_when_interval_passed(self):
+        self.exporter.record_counter('stored_bytes', 10)
+        self.exporter.redis.pipeline.assert_called_once()
@@ -0,0 +1,26 @@
+from unittest import mock
+
+from django.db import transaction
+from django.test import TestCase
+
+from app import tasks
+
+
+class ScheduleFilesDeletionTests(TestCase):
+
+    def test_files_from_rolled_back_savepoint_are_kept(self):
+        with mock.patch.object(tasks, 'send_files_deletion') as send:
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    tasks.schedule_files_deletion(['a'])
+                    try:
+                        with transaction.atomic():
+                            tasks.schedule_files_deletion(['b'])
+                            raise RuntimeError
+                    except RuntimeError:
+                        pass
+                    tasks.schedule_files_deletion(['c'])
+        deleted = [
+            file for call in send.call_args_list for file, _ in call.args[0]
+        ]
+        self.assertEqual(sorted(deleted), ['a', 'c'])
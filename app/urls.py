@@ -0,0 +1,26 @@
+from django.urls import path
+
+from app import views
+
+app_name = 'app'
+
+urlpatterns = [
+    path('uploads/', views.create_upload, name='create_upload'),
+    path(
+        'uploads/<uuid:session_id>/', views.upload_status,
+        name='upload_status'
+    ),
+    path(
+        'uploads/<uuid:session_id>/<int:index>/', views.upload_chunk,
+        name='upload_chunk'
+    ),
+    path(
+        'uploads/<uuid:session_id>/complete/', views.complete_upload,
+        name='complete_upload'
+    ),
+    path(
+        'arrays/<str:app_label>/<str:model_name>/<int:pk>/<str:field_name>/',
+        views.upload_array_files, name='upload_array_files'
+    ),
+    path('metrics/', views.metrics, name='metrics'),
+]
@@ -1,5 +1,14 @@
+import hashlib
+import math
 from urllib.parse import unquote
 
+from django.apps import apps
+from django.contrib.postgres.fields import ArrayField
+from django.db import models
+from django.db.models import F, Func, JSONField, TextField, Value
+from django.db.models.expressions import CombinedExpression
+from django.db.models.functions import Cast
+
 
 def upload_files_path(instance, filename):
     return f'path/to/files/{filename}'
@@ -7,3 +16,195 @@ def upload_files_path(instance, filename):
 
 def is_cyrillic(name):
     return any(ord(c) > 127 for c in unquote(name))
+
+
+def get_file_array_fields():
+    """Все массивы файлов (ArrayField из FileField/ImageField) проекта."""
+    for model in apps.get_models():
+        for field in model._meta.get_fields():
+            if isinstance(field, ArrayField) and isinstance(
+                field.base_field, models.FileField
+            ):
+                yield model, field
+
+
+def find_file_usages(paths):
+    """
+    Где используются файлы: {путь: [(модель, pk), ...]}
+    по всем массивам файлов проекта (поиск по GIN-индексам, &&).
+    """
+    paths = list(set(paths))
+    usages = {path: [] for path in paths}
+    if not paths:
+        return usages
+    fields_by_model = {}
+    for model, field in get_file_array_fields():
+        fields_by_model.setdefault(model, []).append(field.name)
+    for model, field_names in fields_by_model.items():
+        query = models.Q()
+        for field_name in field_names:
+            query |= models.Q(**{f'{field_name}__overlap': paths})
+        rows = model._default_manager.filter(query).values_list(
+            'pk', *field_names
+        )
+        for pk, *arrays in rows:
+            found = usages.keys() & {
+                path for array in arrays for path in array or []
+            }
+            for path in found:
+                usages[path].append((model, pk))
+    return usages
+
+
+def append_to_array(model, pk, field_name, values):
+    """
+    Атомарно дописывает значения в конец массива объекта
+    одним UPDATE (array_cat), не затирая параллельные изменения.
+    """
+    field = model._meta.get_field(field_name)
+    return model.objects.filter(pk=pk).update(**{
+        field_name: Func(
+            F(field_name),
+            Cast(Value(list(values)), output_field=field),
+            function='array_cat',
+            output_field=field
+        )
+    })
+
+
+class ArrayReorder(Func):
+    """
+    Переставляет элементы массива в порядке order.
+    Элементы, которых нет в order (например, добавленные параллельно),
+    остаются в конце в прежнем порядке, а уже удалённые пропускаются.
+    """
+    arity = 2
+
+    def as_sql(self, compiler, connection, **extra_context):
+        array_sql, array_params = compiler.compile(self.source_expressions[0])
+        order_sql, order_params = compiler.compile(self.source_expressions[1])
+        sql = (
+            f'(ARRAY(SELECT o.x FROM unnest({order_sql}) WITH ORDINALITY '
+            f'AS o(x, n) WHERE o.x = ANY({array_sql}) ORDER BY o.n) || '
+            f'ARRAY(SELECT a.x FROM unnest({array_sql}) WITH ORDINALITY '
+            f'AS a(x, n) WHERE a.x <> ALL({order_sql}) ORDER BY a.n))'
+        )
+        params = (*order_params, *array_params, *array_params, *order_params)
+        return sql, params
+
+
+class ArrayLength(Func):
+    """Число элементов массива (0 для NULL)."""
+    function = 'cardinality'
+    template = 'COALESCE(%(function)s(%(expressions)s), 0)'
+    output_field = models.IntegerField()
+
+
+class ArrayHead(Func):
+    """Первые size элементов массива (срез в SQL)."""
+    arity = 1
+
+    def __init__(self, expression, size, **extra):
+        self.size = size
+        super().__init__(expression, **extra)
+
+    def as_sql(self, compiler, connection, **extra_context):
+        array_sql, array_params = compiler.compile(self.source_expressions[0])
+        return f'({array_sql})[1:%s]', (*array_params, self.size)
+
+
+class JSONBSubset(Func):
+    """
+    Часть словаря jsonb {путь: данные} только для ключей из массива keys,
+    чтобы не читать данные обо всех файлах объекта.
+    """
+    arity = 2
+    output_field = JSONField()
+
+    def as_sql(self, compiler, connection, **extra_context):
+        json_sql, json_params = compiler.compile(self.source_expressions[0])
+        keys_sql, keys_params = compiler.compile(self.source_expressions[1])
+        sql = (
+            f'(SELECT COALESCE(jsonb_object_agg(k.x, ({json_sql}) -> k.x), '
+            f"'{{}}'::jsonb) FROM unnest({keys_sql}) AS k(x) "
+            f'WHERE ({json_sql}) ? k.x)'
+        )
+        params = (*json_params, *keys_params, *json_params)
+        return sql, params
+
+
+def array_edit_expression(field, removed=(), order=None, appended=()):
+    """
+    Выражение для UPDATE, которое правит массив на месте:
+    удаляет значения (array_remove), переставляет оставшиеся
+    и дописывает новые в конец (array_cat).
+    Изменения, сделанные параллельно, при этом не затираются.
+    """
+    expression = F(field.name)
+    for value in removed:
+        expression = Func(
+            expression, Value(value),
+            function='array_remove', output_field=field
+        )
+    if order:
+        expression = ArrayReorder(
+            expression, Cast(Value(list(order)), output_field=field),
+            output_field=field
+        )
+    if appended:
+        expression = Func(
+            expression, Cast(Value(list(appended)), output_field=field),
+            function='array_cat', output_field=field
+        )
+    return expression
+
+
+def jsonb_edit_expression(field_name, removed=(), merged=None):
+    """
+    Выражение для UPDATE поля jsonb вида {путь: данные}:
+    убирает ключи removed (jsonb -) и дописывает merged (jsonb ||).
+    """
+    expression = F(field_name)
+    if removed:
+        expression = CombinedExpression(
+            expression, '-',
+            Cast(Value(list(removed)), output_field=ArrayField(TextField())),
+            output_field=JSONField()
+        )
+    if merged:
+        expression = CombinedExpression(
+            expression, '||', Value(merged, output_field=JSONField()),
+            output_field=JSONField()
+        )
+    return expression
+
+
+class BloomFilter:
+    """
+    Компактное вероятностное множество строк.
+    Ложноотрицательных ответов не бывает, ложноположительные
+    возникают с вероятностью error_rate при capacity элементах.
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.size = int(
+            -capacity * math.log(error_rate) / math.log(2) ** 2
+        ) + 1
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(self.size // 8 + 1)
+
+    def _indexes(self, value):
+        digest = hashlib.blake2b(value.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return ((first + i * second) % self.size for i in range(self.hashes))
+
+    def add(self, value):
+        for index in self._indexes(value):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, value):
+        return all(
+            self.bits[index >> 3] & (1 << (index & 7))
+            for index in self._indexes(value)
+        )
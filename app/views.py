@@ -0,0 +1,195 @@
+"""
+Загрузка файлов частями для виджета ChunkedFilesInput.
+
+POST   uploads/                    - создать сессию {name, size, content_type}
+GET    uploads/<id>/               - состояние сессии (для продолжения)
+PUT    uploads/<id>/<номер части>/ - тело запроса - содержимое части
+POST   uploads/<id>/complete/      - завершить загрузку
+
+Форма получает только id завершённых сессий, а файл собирается
+на диске без буферизации в памяти воркера.
+
+POST   arrays/<app>/<модель>/<pk>/<поле>/ - асинхронная загрузка файлов
+                                     (files) и ссылок (urls) в массив
+GET    metrics/                    - метрики загрузки для Prometheus
+"""
+import json
+import os
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db import transaction
+from django.http import (Http404, HttpResponse, HttpResponseNotAllowed,
+                         JsonResponse)
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_GET, require_http_methods
+
+from app import metrics as app_metrics
+from app.async_upload import upload_to_array
+from app.models import UploadSession
+from app.utils import append_to_array, get_file_array_fields
+
+READ_SIZE = 64 * 1024
+
+
+def session_data(session):
+    return {
+        'id': str(session.id),
+        'chunk_size': session.chunk_size,
+        'chunks_count': session.chunks_count,
+        'received_chunks': sorted(set(session.received_chunks)),
+        'completed': session.completed,
+    }
+
+
+def error(message, status=400):
+    return JsonResponse({'error': message}, status=status)
+
+
+@staff_member_required
+@require_http_methods(['POST'])
+def create_upload(request):
+    try:
+        data = json.loads(request.body)
+        file_name = os.path.basename(str(data['name']))[:255]
+        size = int(data['size'])
+        content_type = str(data.get('content_type', ''))[:255]
+    except (ValueError, KeyError, TypeError):
+        return error('Некорректные данные сессии')
+    if not file_name or size <= 0:
+        return error('Пустой файл')
+    if size > settings.CHUNKED_UPLOAD_MAX_SIZE:
+        return error('Файл слишком большой')
+    session = UploadSession.objects.create(
+        file_name=file_name,
+        content_type=content_type,
+        size=size,
+        chunk_size=settings.CHUNKED_UPLOAD_CHUNK_SIZE
+    )
+    os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+    with open(session.path, 'wb') as file:
+        file.truncate(size)
+    return JsonResponse(session_data(session), status=201)
+
+
+@staff_member_required
+@require_GET
+def upload_status(request, session_id):
+    session = get_object_or_404(UploadSession, pk=session_id)
+    return JsonResponse(session_data(session))
+
+
+@staff_member_required
+@require_http_methods(['PUT'])
+def upload_chunk(request, session_id, index):
+    session = get_object_or_404(UploadSession, pk=session_id, completed=False)
+    if index >= session.chunks_count:
+        return error('Некорректный номер части')
+    offset = index * session.chunk_size
+    expected = min(session.chunk_size, session.size - offset)
+    written = 0
+    # часть пишется на своё место в файле потоком, не целиком в память
+    fd = os.open(session.path, os.O_WRONLY)
+    try:
+        while True:
+            data = request.read(READ_SIZE)
+            if not data:
+                break
+            if written + len(data) > expected:
+                return error('Часть больше ожидаемого размера')
+            os.pwrite(fd, data, offset + written)
+            written += len(data)
+    finally:
+        os.close(fd)
+    if written != expected:
+        return error('Часть загружена не полностью')
+    append_to_array(UploadSession, session.pk, 'received_chunks', [index])
+    return JsonResponse({'index': index})
+
+
+@staff_member_required
+@require_http_methods(['POST'])
+def complete_upload(request, session_id):
+    session = get_object_or_404(UploadSession, pk=session_id)
+    missing = session.missing_chunks
+    if missing:
+        return error(f'Не загружены части: {missing}')
+    UploadSession.objects.filter(pk=session.pk).update(completed=True)
+    session.completed = True
+    return JsonResponse(session_data(session))
+
+
+def metrics(request):
+    """
+    Метрики процесса в текстовом формате Prometheus.
+    Доступ по заголовку Authorization: Bearer METRICS_TOKEN,
+    а если токен не задан - только сотрудникам.
+    """
+    exporter = app_metrics.get_exporter(app_metrics.PrometheusExporter)
+    if exporter is None:
+        raise Http404
+    if settings.METRICS_TOKEN:
+        if request.headers.get('Authorization') != (
+            f'Bearer {settings.METRICS_TOKEN}'
+        ):
+            return HttpResponse(status=401)
+    elif not request.user.is_staff:
+        return HttpResponse(status=403)
+    return HttpResponse(
+        exporter.render(), content_type='text/plain; version=0.0.4'
+    )
+
+
+def get_array_model(app_label, model_name, field_name):
+    try:
+        model = apps.get_model(app_label, model_name)
+    except LookupError:
+        raise Http404
+    fields = {
+        array_field.name
+        for array_model, array_field in get_file_array_fields()
+        if array_model is model
+    }
+    if field_name not in fields:
+        raise Http404
+    return model
+
+
+def can_change(request, model):
+    user = request.user
+    return user.is_active and user.is_staff and user.has_perm(
+        f'{model._meta.app_label}.change_{model._meta.model_name}'
+    )
+
+
+@transaction.non_atomic_requests
+async def upload_array_files(request, app_label, model_name, pk, field_name):
+    """
+    Асинхронная загрузка в массив объекта: файлы из files
+    и ссылки из urls (по одной в строке) дописываются в массив.
+    Ответ: {"files": [сохранённые пути], "errors": [ошибки]}.
+    Декораторы require_http_methods и staff_member_required в Django 4.1
+    не поддерживают асинхронные представления, проверки выполняются здесь.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    model = get_array_model(app_label, model_name, field_name)
+    if not await sync_to_async(can_change)(request, model):
+        return error('Недостаточно прав', status=403)
+    try:
+        instance = await model.objects.aget(pk=pk)
+    except model.DoesNotExist:
+        raise Http404
+    # разбор multipart читает тело запроса, это блокирующая операция
+    files, urls = await sync_to_async(
+        lambda: (request.FILES.getlist('files'), request.POST.get('urls', ''))
+    )()
+    urls = [url for url in map(str.strip, urls.split('\n')) if url]
+    if not files and not urls:
+        return error('Нет файлов для загрузки')
+    saved, errors = await upload_to_array(instance, field_name, files, urls)
+    return JsonResponse(
+        {'files': saved, 'errors': errors}, status=200 if saved else 400
+    )
@@ -0,0 +1,420 @@
+"""
+Замеры производительности загрузки и сохранения массивов файлов.
+
+Запуск (нужен PostgreSQL из настроек проекта, создаётся тестовая БД):
+
+    python -m benchmarks.run --scenario files,urls --count 1,10,50 \
+        --size 100000 --storage-latency 0,0.02 --repeat 5
+
+Для каждого сочетания параметров сценарий выполняется --repeat раз
+(после --warmup прогревочных), результаты сохраняются в JSON-файл
+(по умолчанию benchmarks/results/<время>.json), чтобы сравнивать
+производительность между изменениями.
+
+Сценарии:
+    files       POST формы админки с несколькими файлами
+    urls        POST формы админки со ссылками на изображения
+    images      проверка изображений полем формы
+    collisions  check_file_name при большом числе занятых имён
+    delete      массовое удаление объектов из админки
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+from benchmarks.storage import ThrottledStorage
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    def decorator(cls):
+        SCENARIOS[name] = cls
+        return cls
+    return decorator
+
+
+class Scenario:
+    """
+    Сценарий замера: prepare готовит данные итерации (не замеряется),
+    run выполняет замеряемое действие и возвращает число файлов.
+    """
+    def __init__(self, params, client):
+        self.params = params
+        self.client = client
+        self.payload = os.urandom(params['size'])
+
+    def setup(self):
+        pass
+
+    def prepare(self):
+        return None
+
+    def run(self, state):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+    def check_response(self, response, status=302):
+        if response.status_code != status:
+            raise RuntimeError(
+                f'{type(self).__name__}: ответ {response.status_code}'
+            )
+
+
+@scenario('files')
+class FilesScenario(Scenario):
+
+    def run(self, state):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        files = [
+            SimpleUploadedFile(f'file{i}.bin', self.payload)
+            for i in range(self.params['count'])
+        ]
+        self.check_response(self.client.post(
+            '/admin/app/modelwithfilesarray/add/', {'files': files}
+        ))
+        return len(files)
+
+
+@scenario('urls')
+class URLsScenario(Scenario):
+
+    def setup(self):
+        from benchmarks.stub_server import StubServer, make_png
+
+        files = {
+            f'image{i}.png': make_png(self.params['size'], i)
+            for i in range(self.params['count'])
+        }
+        self.server = StubServer(files, self.params['http_latency'])
+        self.server.__enter__()
+        self.urls = '\n'.join(f'{self.server.url}/{name}' for name in files)
+
+    def run(self, state):
+        self.check_response(self.client.post(
+            '/admin/app/modelwithimagesarray/add/', {'images': self.urls}
+        ))
+        return self.params['count']
+
+    def teardown(self):
+        self.server.__exit__()
+
+
+@scenario('images')
+class ImagesScenario(Scenario):
+
+    def setup(self):
+        from app.fields import ImagesArrayFilesInputField
+        from benchmarks.stub_server import make_png
+
+        self.field = ImagesArrayFilesInputField(required=False)
+        self.images = [
+            make_png(self.params['size'], i)
+            for i in range(self.params['count'])
+        ]
+
+    def run(self, state):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        files = self.field.clean([
+            SimpleUploadedFile(f'image{i}.png', image)
+            for i, image in enumerate(self.images)
+        ])
+        return len(files)
+
+
+@scenario('collisions')
+class CollisionsScenario(Scenario):
+    """
+    Занято count имён из 32 возможных суффиксов (алфавит 'ab'),
+    поэтому check_file_name делает много проверок наличия файла.
+    """
+    name = 'path/to/files/collision.bin'
+    symbols = 'ab'
+
+    def setup(self):
+        from django.conf import settings
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+
+        self.symbols, settings.SYMBOLS = settings.SYMBOLS, self.symbols
+        latency, ThrottledStorage.latency = ThrottledStorage.latency, 0
+        default_storage.save(self.name, ContentFile(b''))
+        suffixes = list(itertools.product(settings.SYMBOLS, repeat=5))
+        for suffix in suffixes[:min(self.params['count'], 31)]:
+            default_storage.save(
+                f'path/to/files/collision_{"".join(suffix)}.bin',
+                ContentFile(b'')
+            )
+        ThrottledStorage.latency = latency
+
+    def run(self, state):
+        from app.naming import check_file_name
+
+        check_file_name(self.name)
+        return 1
+
+    def teardown(self):
+        from django.conf import settings
+
+        settings.SYMBOLS = self.symbols
+
+
+@scenario('delete')
+class DeleteScenario(Scenario):
+
+    def prepare(self):
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+
+        from app.models import ModelWithFilesArray
+
+        latency, ThrottledStorage.latency = ThrottledStorage.latency, 0
+        objects = ModelWithFilesArray.objects.bulk_create([
+            ModelWithFilesArray(files=[default_storage.save(
+                f'path/to/files/delete{i}.bin', ContentFile(self.payload)
+            )])
+            for i in range(self.params['count'])
+        ])
+        ThrottledStorage.latency = latency
+        return [instance.pk for instance in objects]
+
+    def run(self, state):
+        self.check_response(self.client.post(
+            '/admin/app/modelwithfilesarray/', {
+                'action': 'delete_selected',
+                '_selected_action': state,
+                'post': 'yes',
+            }
+        ))
+        return len(state)
+
+
+def configure(args):
+    sys.path.insert(0, BASE_DIR)
+    os.environ.setdefault(
+        'DJANGO_SETTINGS_MODULE', 'django_admin_array_files_upload.settings'
+    )
+    import django
+    from django.conf import settings
+
+    django.setup()
+    settings.ALLOWED_HOSTS = ['*']
+    settings.DEBUG = False
+    settings.MEDIA_ROOT = tempfile.mkdtemp(prefix='array_files_bench_')
+    settings.DEFAULT_FILE_STORAGE = 'benchmarks.storage.ThrottledStorage'
+    # HTTP-заглушка работает на 127.0.0.1, лимит запросов не нужен
+    settings.URL_FETCH_ALLOWED_HOSTS = ['127.0.0.1']
+    settings.URL_FETCH_HOST_RATE = 0
+    settings.CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'
+        }
+    }
+    from django_admin_array_files_upload.celery import app
+
+    # задачи (удаление, производные) выполняются синхронно,
+    # их время входит в замер
+    app.conf.task_always_eager = True
+
+
+def get_client():
+    from django.contrib.auth.models import User
+    from django.test import Client
+
+    user, _ = User.objects.get_or_create(
+        username='benchmark',
+        defaults={'is_staff': True, 'is_superuser': True}
+    )
+    client = Client()
+    client.force_login(user)
+    return client
+
+
+def summarize(timings, files, size):
+    total = sum(timings)
+    ordered = sorted(timings)
+    return {
+        'timings': {
+            'mean': statistics.mean(timings),
+            'median': statistics.median(timings),
+            'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+            'min': ordered[0],
+            'max': ordered[-1],
+            'stdev': statistics.stdev(timings) if len(timings) > 1 else 0,
+        },
+        'throughput': {
+            'ops_per_sec': len(timings) / total if total else None,
+            'files_per_sec': files / total if total else None,
+            'bytes_per_sec': files * size / total if total else None,
+        },
+    }
+
+
+def run_scenario(name, params, args, client):
+    from app import metrics
+
+    ThrottledStorage.latency = params['storage_latency']
+    bench = SCENARIOS[name](params, client)
+    bench.setup()
+    timings = []
+    files = 0
+    peak = 0
+    summary = metrics.Summary()
+    try:
+        for iteration in range(args.warmup + args.repeat):
+            state = bench.prepare()
+            if args.trace_memory:
+                tracemalloc.reset_peak()
+            with metrics.collect() as iteration_summary:
+                start = time.perf_counter()
+                processed = bench.run(state)
+                elapsed = time.perf_counter() - start
+            if iteration < args.warmup:
+                continue
+            timings.append(elapsed)
+            files += processed
+            if args.trace_memory:
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+            for span, (count, seconds) in iteration_summary.spans.items():
+                summary.spans[span][0] += count
+                summary.spans[span][1] += seconds
+            for counter, value in iteration_summary.counters.items():
+                summary.counters[counter] += value
+    finally:
+        bench.teardown()
+    result = {'scenario': name, 'params': params}
+    result.update(summarize(timings, files, params['size']))
+    result['memory'] = {
+        'tracemalloc_peak_bytes': peak if args.trace_memory else None,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    result['metrics'] = {
+        'spans': {
+            span: {'count': count, 'seconds': seconds}
+            for span, (count, seconds) in summary.spans.items()
+        },
+        'counters': dict(summary.counters),
+    }
+    return result
+
+
+def get_environment():
+    import django
+    from django.db import connection
+
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=BASE_DIR, text=True,
+            stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def parse_list(value, cast):
+    return [cast(item) for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--scenario', default=','.join(SCENARIOS),
+        help=f'Сценарии через запятую: {", ".join(SCENARIOS)}.'
+    )
+    parser.add_argument('--count', default='10', help='Число файлов.')
+    parser.add_argument('--size', default='100000', help='Размер файла, байт.')
+    parser.add_argument(
+        '--storage-latency', default='0',
+        help='Задержка операций хранилища, сек.'
+    )
+    parser.add_argument(
+        '--http-latency', type=float, default=0,
+        help='Задержка ответа HTTP-заглушки, сек.'
+    )
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument(
+        '--trace-memory', action='store_true',
+        help='Замерять пик выделенной памяти (tracemalloc, медленнее).'
+    )
+    parser.add_argument(
+        '--keepdb', action='store_true',
+        help='Не пересоздавать тестовую БД.'
+    )
+    parser.add_argument('--output', help='Файл для результатов (JSON).')
+    args = parser.parse_args(argv)
+    scenarios = parse_list(args.scenario, str)
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'неизвестные сценарии: {", ".join(sorted(unknown))}')
+
+    configure(args)
+    from django.test.utils import setup_databases, teardown_databases
+
+    databases = setup_databases(
+        verbosity=0, interactive=False, keepdb=args.keepdb
+    )
+    if args.trace_memory:
+        tracemalloc.start()
+    results = []
+    try:
+        client = get_client()
+        for name, count, size, latency in itertools.product(
+            scenarios, parse_list(args.count, int), parse_list(args.size, int),
+            parse_list(args.storage_latency, float)
+        ):
+            params = {
+                'count': count, 'size': size, 'storage_latency': latency,
+                'http_latency': args.http_latency, 'repeat': args.repeat,
+            }
+            result = run_scenario(name, params, args, client)
+            results.append(result)
+            print(
+                f'{name:<11} count={count:<5} size={size:<9} '
+                f'latency={latency:<6} '
+                f'median={result["timings"]["median"] * 1000:.1f} мс '
+                f'files/s={result["throughput"]["files_per_sec"]:.1f}'
+            )
+    finally:
+        teardown_databases(databases, verbosity=0, keepdb=args.keepdb)
+
+    output = args.output or os.path.join(
+        BASE_DIR, 'benchmarks', 'results',
+        datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ.json')
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump({
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'environment': get_environment(),
+            'results': results,
+        }, file, ensure_ascii=False, indent=2)
+    print(f'Результаты: {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+import time
+
+from django.core.files.storage import FileSystemStorage
+
+
+class ThrottledStorage(FileSystemStorage):
+    """
+    Файловое хранилище с искусственной задержкой операций,
+    имитирующее сетевое хранилище (S3 и т.п.).
+    Задержка в секундах задаётся атрибутом latency.
+    """
+    latency = 0
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _save(self, name, content):
+        self._wait()
+        return super()._save(name, content)
+
+    def exists(self, name):
+        self._wait()
+        return super().exists(name)
+
+    def delete(self, name):
+        self._wait()
+        return super().delete(name)
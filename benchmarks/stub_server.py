@@ -0,0 +1,67 @@
+"""HTTP-сервер для сценариев загрузки по ссылкам."""
+import http.server
+import io
+import threading
+import time
+
+from PIL import Image
+
+
+def make_png(size, seed=0):
+    """PNG размером примерно size байт (шум плохо сжимается)."""
+    side = max(1, int((size / 3) ** 0.5))
+    image = Image.effect_noise((side, side), 64 + seed % 64).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'PNG', compress_level=1)
+    return buffer.getvalue()
+
+
+class StubServer:
+    """
+    Отдаёт заранее сгенерированные файлы по адресам /<имя>
+    с задержкой latency перед ответом.
+    """
+    def __init__(self, files, latency=0):
+        self.files = files
+        self.latency = latency
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                body = server.files.get(self.path.lstrip('/'))
+                if server.latency:
+                    time.sleep(server.latency)
+                if body is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, daemon=True
+        )
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f'http://{host}:{port}'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
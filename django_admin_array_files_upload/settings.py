@@ -1,4 +1,5 @@
 import os
+import tempfile
 from pathlib import Path
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -93,3 +94,149 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 SYMBOLS = 'AaBbCcDdEeFfGgHhIiJjKkLlMmNnOoPpQqRrSsTtUuVvWwXxYyZz1234567890'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.getenv('REDIS_CACHE_URL', 'redis://redis:6379/2'),
+    }
+}
+
+# загрузка файлов по ссылкам
+URL_FETCH_MAX_WORKERS = int(os.getenv('URL_FETCH_MAX_WORKERS', 8))
+URL_FETCH_TIMEOUT = (5, 30)  # (подключение, чтение) на одну ссылку, сек.
+URL_FETCH_TOTAL_TIMEOUT = 120  # на все ссылки формы, сек.
+URL_UPLOAD_MAX_SIZE = 100 * 1024 * 1024  # максимальный размер файла, байт
+URL_FETCH_CHUNK_SIZE = 64 * 1024
+URL_FETCH_MAX_REDIRECTS = 5
+URL_FETCH_POOL_HOSTS = 32  # хостов с отдельным пулом соединений
+# запросов в секунду к одному хосту (0 - без ограничения) и пачка подряд
+URL_FETCH_HOST_RATE = float(os.getenv('URL_FETCH_HOST_RATE', 10))
+URL_FETCH_HOST_BURST = 20
+# после стольких ошибок подряд хост отключается на время, сек.
+URL_FETCH_BREAKER_THRESHOLD = 5
+URL_FETCH_BREAKER_COOLDOWN = 30
+# запрет загрузки с адресов внутренних сетей (SSRF),
+# хосты из URL_FETCH_ALLOWED_HOSTS разрешены всегда
+URL_FETCH_BLOCK_PRIVATE = bool(int(os.getenv('URL_FETCH_BLOCK_PRIVATE', 1)))
+URL_FETCH_ALLOWED_HOSTS = [
+    host.strip()
+    for host in os.getenv('URL_FETCH_ALLOWED_HOSTS', '').split(',')
+    if host.strip()
+]
+# кэш скачанных файлов с условными запросами (0 - отключён)
+URL_CACHE_DIR = os.getenv(
+    'URL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'array_url_cache')
+)
+URL_CACHE_MAX_SIZE = int(os.getenv('URL_CACHE_MAX_SIZE', 1024 * 1024 * 1024))
+
+# число потоков для параллельной записи и удаления файлов в хранилище
+STORAGE_MAX_WORKERS = int(os.getenv('STORAGE_MAX_WORKERS', 8))
+
+# кэш URL файлов: алиас из CACHES и время жизни записей, сек.
+# для подписанных ссылок время жизни должно быть меньше срока их действия
+STORAGE_URL_CACHE = 'default'
+STORAGE_URL_CACHE_TIMEOUT = 60 * 60
+
+# экспорт метрик загрузки (app/metrics.py)
+# (app.metrics.LogExporter - каждое значение в лог, для отладки)
+METRICS_EXPORTERS = [
+    'app.metrics.RedisPrometheusExporter',
+]
+# алиас кэша django-redis, в котором копятся метрики всех процессов
+METRICS_REDIS_CACHE = 'default'
+# как часто процесс отправляет накопленные метрики в Redis, секунд
+METRICS_FLUSH_INTERVAL = 10
+# токен для /array-files/metrics/, без него метрики видны только сотрудникам
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# LogExporter пишет метрики в лог app.metrics с уровнем DEBUG,
+# поэтому для отладки нужен ещё METRICS_LOG_LEVEL=DEBUG
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'simple': {
+            'format': '{asctime} {levelname} {name} {message}',
+            'style': '{',
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'simple',
+        },
+    },
+    'loggers': {
+        'app': {
+            'handlers': ['console'],
+            'level': os.getenv('APP_LOG_LEVEL', 'INFO'),
+        },
+        'app.metrics': {
+            'handlers': ['console'],
+            'level': os.getenv('METRICS_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+# стратегия именования файлов: compat, uuid, date, hash или путь к функции
+FILES_NAMING_STRATEGY = os.getenv('FILES_NAMING_STRATEGY', 'uuid')
+
+FILE_UPLOAD_HANDLERS = [
+    'app.upload_handlers.HashingMemoryFileUploadHandler',
+    'app.upload_handlers.HashingTemporaryFileUploadHandler',
+]
+
+# хранить одинаковые по содержимому файлы в одном экземпляре
+FILES_DEDUPLICATE = bool(int(os.getenv('FILES_DEDUPLICATE', 0)))
+
+# разрешённые типы файлов (определяются по содержимому, допустимы маски
+# вида image/*), пустой список - любые
+FILES_ALLOWED_TYPES = [
+    content_type.strip()
+    for content_type in os.getenv('FILES_ALLOWED_TYPES', '').split(',')
+    if content_type.strip()
+]
+
+# ограничения для загружаемых изображений (проверяются по заголовку файла)
+IMAGE_ALLOWED_FORMATS = ['JPEG', 'PNG', 'GIF', 'WEBP', 'BMP', 'TIFF']
+IMAGE_MAX_WIDTH = 10000
+IMAGE_MAX_HEIGHT = 10000
+IMAGE_MAX_PIXELS = 50_000_000
+# полное декодирование изображения при проверке (медленнее, но надёжнее)
+IMAGE_FULL_DECODE = False
+
+# производные изображения (миниатюры), создаются задачами celery
+IMAGE_RENDITIONS = {
+    'thumb': {'size': (200, 200), 'format': 'WEBP', 'quality': 80},
+    'medium': {'size': (1024, 1024), 'format': 'WEBP', 'quality': 85},
+}
+# файлов в одной задаче создания производных (задачи идут группой)
+RENDITIONS_CHUNK_SIZE = 8
+
+# удаление файлов из хранилища задачами celery
+FILES_DELETE_CHUNK_SIZE = 500
+FILES_DELETE_MAX_RETRIES = 5
+
+CELERY_BEAT_SCHEDULE = {
+    'delete-expired-upload-sessions': {
+        'task': 'app.tasks.delete_expired_upload_sessions',
+        'schedule': 60 * 60,
+    },
+}
+if bool(int(os.getenv('FILES_GC_PERIODIC', 0))):
+    # раз в сутки удаляем файлы, на которые нет ссылок (нужен celery beat)
+    CELERY_BEAT_SCHEDULE['collect-orphan-files'] = {
+        'task': 'app.tasks.collect_orphan_files',
+        'schedule': 24 * 60 * 60,
+    }
+
+# загрузка файлов частями (виджет ChunkedFilesInput)
+CHUNKED_UPLOAD_DIR = os.getenv(
+    'CHUNKED_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'array_uploads')
+)
+CHUNKED_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+CHUNKED_UPLOAD_PARALLEL = 4  # одновременно загружаемых частей в браузере
+CHUNKED_UPLOAD_MAX_SIZE = 10 * 1024 * 1024 * 1024
+CHUNKED_UPLOAD_EXPIRE_HOURS = 24